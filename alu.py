@@ -1,12 +1,11 @@
-import warnings
-
-warnings.simplefilter("ignore", RuntimeWarning)
+# Values are unsigned 16 bit, results are masked back to 16 bits
+bit_mask = 0xFFFF
 
 def execute_add(inst_list):
-    return inst_list[0] + inst_list[1]
+    return (inst_list[0] + inst_list[1]) & bit_mask
 
 def execute_not(inst_list):
-    return ~inst_list
+    return ~inst_list & bit_mask
 
 def execute_and(inst_list):
-    return inst_list[0] & inst_list[1]
\ No newline at end of file
+    return inst_list[0] & inst_list[1] & bit_mask
\ No newline at end of file
@@ -0,0 +1,344 @@
+#
+# Optional execution engine that translates LC3 basic blocks into Python functions
+#
+# A block is a run of instructions ending at an unconditional BR, JSR/JSRR or RET,
+# conditional branches leave it when taken. It is compiled once into a function that
+# keeps the registers and CC in local variables, and returns the next PC, the number
+# of instructions executed and whether it bailed out to the interpreter.
+# A block with a branch back to its own start loops inside the function.
+# Loads from device registers go through the machine's device bus. TRAP, RTI, device stores,
+# watched addresses and stores into translated code are left to the machine's interpreter,
+# so they keep their exact behaviour.
+#
+
+from devices import device_page
+from machine import MCR, halt_address, split_until, HALTED, MAX_STEPS, BREAKPOINT, UNTIL
+
+max_block_length = 64
+loop_budget = 1 << 12  # Instructions a looping block runs per call, so pauses and new breakpoints are seen
+
+# Opcodes that end a block
+terminators = (0b0100, 0b1100)  # JSR/JSRR, RET/JMP, and BR when it always branches
+# Opcodes that are never translated and always go through the interpreter
+interpreted = (0b1000, 0b1101, 0b1111)  # RTI, reserved, TRAP
+
+
+class Block(object):
+    def __init__(self, start, length, function, source):
+        self.start = start
+        self.length = length
+        self.function = function
+        self.source = source
+
+    def __contains__(self, address):
+        return self.start <= address < self.start + self.length
+
+
+class BlockEngine(object):
+    def __init__(self, machine):
+        self.machine = machine
+        self.memory = machine.memory
+        self.registers = machine.registers
+        self.blocks = {}
+        self.breakpoints_version = None  # Breakpoints the blocks were split at
+        self.stop_at = None  # Address the blocks were split at for Machine.run's until
+        self.env = {}  # Globals shared by every compiled block
+        self.untranslatable = set()  # Addresses where a block can't start
+        # Blocks read the register list itself, NumPy registers through item to get plain ints
+        self.read_register = 'R[%d]' if isinstance(self.registers.registers, list) else 'R.item(%d)'
+        machine.memory.engine = self
+
+    # Runs for Machine.run, until is only checked between blocks when it is a function
+    # Returns the number of instructions executed and why it stopped
+    def run(self, max_steps, until):
+        machine = self.machine
+        mem = self.memory
+        regs = self.registers
+        stop_at, until = split_until(until)
+        if stop_at != self.stop_at:  # Blocks are split at stop_at as well, start over
+            self.flush()
+            self.stop_at = stop_at
+        self.refresh()
+        blocks = self.blocks
+        breakpoints = mem.breakpoints
+        break_flags = breakpoints.flags
+        interrupts = machine.interrupts
+        # Looping blocks go around at most this many instructions per call, none when until is a function
+        budget = loop_budget if until is None else 0
+        steps = 0
+        # Blocks leave device stores to the interpreter, so only it can halt the machine through the MCR
+        if not mem[MCR] & 0x8000:
+            return steps, HALTED
+        while True:
+            if steps == max_steps:
+                return steps, MAX_STEPS
+            if breakpoints.version != self.breakpoints_version:  # Blocks are split at breakpoints, start over
+                self.flush()
+                self.breakpoints_version = breakpoints.version
+            pc = regs.PC
+            block = blocks.get(pc)
+            if block is None and pc not in self.untranslatable:
+                block = self.translate(pc)
+            # While interrupts are armed they are checked after every instruction, so run one at a time
+            if block is None or interrupts.armed or (max_steps is not None and steps + block.length > max_steps):
+                interpret = True
+            else:
+                pc, executed, interpret = block.function(budget if max_steps is None else min(budget, max_steps - steps))
+                regs.PC = pc
+                steps += executed
+            if interpret:  # Also when a block bailed out before an instruction it can't handle
+                machine.execute_next()
+                steps += 1
+                if not mem[MCR] & 0x8000:
+                    return steps, HALTED
+                pc = regs.PC
+            elif not machine.ON and pc == halt_address:
+                mem[MCR] = 0x7FFF
+                return steps, HALTED
+            if break_flags[pc] and breakpoints.hit(pc, regs, mem):
+                return steps, BREAKPOINT
+            if mem.paused:
+                return steps, machine.pause_reason()
+            if pc == stop_at or (until is not None and until(machine)):
+                return steps, UNTIL
+
+    # Point the compiled blocks at the current machine state
+    def refresh(self):
+        mem = self.memory
+        self.env.update(R=self.registers.registers, I=self.registers, M=mem.memory, item=mem.reader(),
+                        read=self.machine.bus.read,
+                        decoded=mem.decoded, translated=mem.translated, changed=mem.mark_dirty,
+                        watch=mem.watchpoints.flags)
+
+    def flush(self):
+        self.blocks.clear()
+        self.untranslatable.clear()
+        self.memory.translated[:] = bytearray(len(self.memory.translated))
+
+    # Drop every block containing address, called by Memory when a translated word is written
+    def invalidate(self, address):
+        removed = []
+        for start in range(address - max_block_length + 1, address + 1):
+            block = self.blocks.get(start)
+            if block is not None and address in block:
+                removed.append(self.blocks.pop(start))
+        self.untranslatable.discard(address)
+        self.unmark(removed)
+
+    # Drop every block overlapping [start, stop), used when whole programs are loaded
+    def invalidate_range(self, start, stop):
+        removed = [block for block in self.blocks.values()
+                   if block.start < stop and start < block.start + block.length]
+        for block in removed:
+            del self.blocks[block.start]
+        self.untranslatable.difference_update(range(start, stop))
+        self.unmark(removed)
+
+    # Drop every block containing one of addresses, given in increasing order, used when memory is
+    # restored or reloaded a word here and there
+    def invalidate_words(self, addresses):
+        translated = self.memory.translated
+        self.untranslatable.difference_update(addresses)
+        start = stop = None
+        for address in addresses:
+            if not translated[address]:  # Also skips words of blocks already dropped with an earlier run
+                continue
+            if address != stop:
+                if start is not None:
+                    self.invalidate_range(start, stop)
+                start = address
+            stop = address + 1
+        if start is not None:
+            self.invalidate_range(start, stop)
+
+    # Clear the translated flags of removed blocks, keeping the ones still covered by other blocks
+    def unmark(self, removed):
+        translated = self.memory.translated
+        for block in removed:
+            translated[block.start:block.start + block.length] = bytearray(block.length)
+        for block in self.blocks.values():
+            for old in removed:
+                if block.start < old.start + old.length and old.start < block.start + block.length:
+                    translated[block.start:block.start + block.length] = b'\x01' * block.length
+                    break
+
+    def translate(self, start):
+        entries = self.find_block(start)
+        if not entries:
+            self.untranslatable.add(start)
+            return None
+        back = None  # The first branch back to start, unless the run loop has to see start
+        if start not in self.memory.breakpoints and start != self.stop_at:
+            for i, entry in enumerate(entries):
+                if entry[0] == 0b0000 and entry[1] and (start + i + 1 + entry[7]) & 0xFFFF == start:
+                    back = i
+                    break
+        source = generate_source(start, entries, self.read_register, back)
+        code = compile(source, '<block x%04X>' % start, 'exec')
+        exec code in self.env
+        block = Block(start, len(entries), self.env.pop('block'), source)
+        self.blocks[start] = block
+        self.memory.translated[start:start + block.length] = b'\x01' * block.length
+        return block
+
+    # Collect the predecoded entries making up the block starting at start
+    def find_block(self, start):
+        entries = []
+        pc = start
+        while len(entries) < max_block_length:
+            if entries and (pc in self.memory.breakpoints or pc == self.stop_at):
+                break  # Let the run loop see the breakpoint
+            entry = self.memory.fetch(pc)
+            opcode = entry[0]
+            if opcode in interpreted:
+                break
+            if opcode in (0b0010, 0b0011, 0b1010, 0b1011):  # LD, ST, LDI, STI use a fixed address
+                if (pc + 1 + entry[7]) & 0xFFFF >= device_page:
+                    break
+            if opcode == 0b1011 and self.memory[(pc + 1 + entry[7]) & 0xFFFF] >= device_page:
+                break  # An STI that stores to a device register now, like the OS output routines, would bail out
+            entries.append(entry)
+            if opcode in terminators or (opcode == 0b0000 and entry[1] == 0b111) or pc == 0xFFFF:
+                break
+            pc += 1
+        return entries
+
+
+# read_register formats the expression reading a register from R, the block goes around again
+# when the branch at index back is taken, while budget allows another pass
+def generate_source(start, entries, read_register, back=None):
+    used = set()
+    written = set()
+    for entry in entries:
+        opcode, DR, SR1, SR2 = entry[:4]
+        if opcode in (0b0001, 0b0101, 0b1001, 0b0010, 0b1010, 0b0110, 0b1110):  # Instructions with a DR
+            written.add(DR)
+        if opcode in (0b0001, 0b0101, 0b1001, 0b0110, 0b0111, 0b1100) or (opcode == 0b0100 and not entry[10]):
+            used.add(SR1)
+        if opcode in (0b0001, 0b0101) and not entry[4]:
+            used.add(SR2)
+        if opcode in (0b0011, 0b1011, 0b0111):  # Stores read the register in the DR field
+            used.add(DR)
+        if opcode == 0b0100:  # JSR/JSRR write the return address to R7
+            written.add(7)
+    written = sorted(written)
+
+    lines = ['def block(budget):']
+    for register in sorted(used | set(written)):
+        lines.append('    r%d = %s' % (register, read_register % register))
+    loop = back is not None
+    body = '    '
+    if loop:  # Passes after the first keep the CC they branched on in cc
+        lines.append('    cc = I.CC')
+        lines.append('    done = 0')
+        lines.append('    while True:')
+        body = '        '
+
+    def emit(line):
+        lines.append(body + line)
+
+    # Store registers and CC back into the machine, then return next_pc, the number of instructions
+    # executed and whether the interpreter has to execute the next one
+    def exit_block(indent, next_pc, executed, cc_ready=False, bailed=False):
+        out = []
+        for register in written:
+            out.append('R[%d] = r%d' % (register, register))
+        if cc_set and not cc_ready:
+            out.append('cc = 4 if ccv & 0x8000 else (2 if ccv == 0 else 1)')
+        if cc_set or loop:
+            out.append('I.CC = cc')
+            out.append('I.PSR = (I.PSR & 0xFFF8) + cc')
+        if executed:
+            out.append('I.IR = %d' % entries[executed - 1][-1])
+        elif loop:  # Bailed out at the start of a later pass
+            out.append('if done:')
+            out.append('    I.IR = %d' % entries[back][-1])
+        count = 'done + %d' % executed if loop else '%d' % executed
+        out.append('return %s, %s, %s' % (next_pc, count, bailed))
+        return [body + indent + line for line in out]
+
+    cc_set = False
+    for i, entry in enumerate(entries):
+        opcode, DR, SR1, SR2, imm, imm5, offset6, offset9, offset11 = entry[:9]
+        pc = start + i
+        next_pc = (pc + 1) & 0xFFFF
+        emit('# x%04X' % pc)
+        if opcode == 0b0001:  # ADD
+            operand = '%d' % (imm5 & 0xFFFF) if imm else 'r%d' % SR2
+            emit('r%d = (r%d + %s) & 0xFFFF' % (DR, SR1, operand))
+        elif opcode == 0b0101:  # AND
+            operand = '%d' % (imm5 & 0xFFFF) if imm else 'r%d' % SR2
+            emit('r%d = r%d & %s' % (DR, SR1, operand))
+        elif opcode == 0b1001:  # NOT
+            emit('r%d = r%d ^ 0xFFFF' % (DR, SR1))
+        elif opcode == 0b1110:  # LEA
+            emit('r%d = %d' % (DR, (next_pc + offset9) & 0xFFFF))
+        elif opcode in (0b0010, 0b1010, 0b0110):  # LD, LDI, LDR
+            # Watched addresses are left to the interpreter, device registers are read through the bus
+            if opcode == 0b0010:
+                emit('a = %d' % ((next_pc + offset9) & 0xFFFF))
+                emit('if watch[a]:')
+            else:
+                if opcode == 0b1010:
+                    pointer = (next_pc + offset9) & 0xFFFF
+                    emit('a = item(%d)' % pointer)
+                    emit('if watch[a] or watch[%d]:' % pointer)
+                else:
+                    emit('a = (r%d + %d) & 0xFFFF' % (SR1, offset6 & 0xFFFF))
+                    emit('if watch[a]:')
+            lines.extend(exit_block('    ', pc, i, bailed=True))
+            if opcode == 0b0010:  # find_block leaves device registers at fixed addresses to the interpreter
+                emit('r%d = item(a)' % DR)
+            else:
+                emit('r%d = item(a) if a < %d else read(a)' % (DR, device_page))
+        elif opcode in (0b0011, 0b1011, 0b0111):  # ST, STI, STR
+            # Device registers, watched addresses and translated code are left to the interpreter
+            if opcode == 0b0011:
+                emit('a = %d' % ((next_pc + offset9) & 0xFFFF))
+                emit('if translated[a] or watch[a]:')
+            else:
+                if opcode == 0b1011:
+                    pointer = (next_pc + offset9) & 0xFFFF
+                    emit('a = item(%d)' % pointer)
+                    emit('if a >= %d or translated[a] or watch[a] or watch[%d]:' % (device_page, pointer))
+                else:
+                    emit('a = (r%d + %d) & 0xFFFF' % (SR1, offset6 & 0xFFFF))
+                    emit('if a >= %d or translated[a] or watch[a]:' % device_page)
+            lines.extend(exit_block('    ', pc, i, bailed=True))
+            emit('M[a] = r%d' % DR)
+            emit('decoded[a] = None')
+            emit('changed(a)')
+
+        if opcode in (0b0001, 0b0101, 0b1001, 0b1110, 0b0010, 0b1010, 0b0110):  # Instructions that set CC
+            emit('ccv = r%d' % DR)
+            cc_set = True
+
+        if opcode == 0b0000:  # BR
+            if cc_set:
+                emit('cc = 4 if ccv & 0x8000 else (2 if ccv == 0 else 1)')
+            elif not loop:
+                emit('cc = I.CC')
+            if i == back:  # Back to start, while another pass fits in the budget
+                emit('if cc & %d and done + %d <= budget:' % (DR, i + 1 + len(entries)))
+                emit('    done += %d' % (i + 1))
+                emit('    continue')
+            target = (next_pc + offset9) & 0xFFFF
+            if i == len(entries) - 1:
+                lines.extend(exit_block('', '%d if cc & %d else %d' % (target, DR, next_pc), i + 1, cc_ready=True))
+            else:
+                emit('if cc & %d:' % DR)
+                lines.extend(exit_block('    ', '%d' % target, i + 1, cc_ready=True))
+        elif opcode == 0b0100:  # JSR, JSRR
+            if entry[10]:
+                target = '%d' % ((next_pc + offset11) & 0xFFFF)
+            else:
+                emit('a = r%d' % SR1)
+                target = 'a'
+            emit('r7 = %d' % next_pc)
+            lines.extend(exit_block('', target, i + 1))
+        elif opcode == 0b1100:  # RET, JMP
+            lines.extend(exit_block('', 'r%d' % SR1, i + 1))
+
+    if entries[-1][0] not in (0b0000, 0b0100, 0b1100):
+        lines.extend(exit_block('', '%d' % ((start + len(entries)) & 0xFFFF), len(entries)))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,280 @@
+#
+# Debugging support: breakpoints, watchpoints and the conditions attached to them
+#
+
+import re
+from collections import namedtuple
+
+nrow = 65536
+
+# Watchpoint flags
+WATCH_WRITE = 0b01
+WATCH_READ = 0b10
+
+
+# Breakpoint index, a flag per address so the run loop only needs one lookup per instruction
+# Breakpoints stay set after they are hit, and count their hits
+class Breakpoints(object):
+    def __init__(self):
+        self.flags = bytearray(nrow)
+        self.hits = {}  # Address -> times execution reached it
+        self.ignore = {}  # Address -> hits left before it stops execution
+        self.conditions = {}  # Address -> Condition that has to hold for it to stop execution
+        self.version = 0  # Bumped on every change, lets translated code notice new breakpoints
+
+    def __contains__(self, address):
+        return self.flags[address] == 1
+
+    def __iter__(self):
+        return iter(sorted(self.hits))
+
+    def __len__(self):
+        return len(self.hits)
+
+    # Set a breakpoint, the first ignore_count hits where its condition holds won't stop execution
+    def add(self, address, ignore_count=0, condition=None):
+        address &= 0xFFFF
+        self.flags[address] = 1
+        self.hits[address] = 0
+        self.ignore[address] = ignore_count
+        self.conditions[address] = condition
+        self.version += 1
+
+    def remove(self, address):
+        address &= 0xFFFF
+        if self.flags[address]:
+            self.flags[address] = 0
+            del self.hits[address]
+            del self.ignore[address]
+            del self.conditions[address]
+            self.version += 1
+
+    # Returns True if the breakpoint is now set
+    def toggle(self, address):
+        if address in self:
+            self.remove(address)
+            return False
+        self.add(address)
+        return True
+
+    def set_ignore_count(self, address, ignore_count):
+        if address in self:
+            self.ignore[address] = ignore_count
+
+    def set_condition(self, address, condition):
+        if address in self:
+            self.conditions[address] = condition
+
+    def clear(self):
+        self.flags[:] = bytearray(nrow)
+        self.hits.clear()
+        self.ignore.clear()
+        self.conditions.clear()
+        self.version += 1
+
+    # Called when execution reaches a flagged address, returns True if it should stop there
+    def hit(self, address, registers, memory):
+        hits = self.hits[address] = self.hits[address] + 1
+        condition = self.conditions[address]
+        if condition is not None and not condition(registers, memory, hits):
+            return False
+        if self.ignore[address] > 0:
+            self.ignore[address] -= 1
+            return False
+        return True
+
+
+# A watched range [start, stop) and the accesses that trigger it
+class Watch(object):
+    def __init__(self, start, stop, kinds, condition=None):
+        self.start = start
+        self.stop = stop
+        self.kinds = kinds
+        self.condition = condition
+        self.hits = 0
+
+    def __contains__(self, address):
+        return self.start <= address < self.stop
+
+    def __str__(self):
+        end = '' if self.stop == self.start + 1 else '-x%04X' % (self.stop - 1)
+        kinds = ('r' if self.kinds & WATCH_READ else '') + ('w' if self.kinds & WATCH_WRITE else '')
+        condition = '' if self.condition is None else ' if ' + self.condition.text
+        return 'x%04X%s:%s%s' % (self.start, end, kinds, condition)
+
+
+# What stopped execution: the instruction at pc accessed address, changing old to new
+WatchHit = namedtuple('WatchHit', ['address', 'kind', 'old', 'new', 'pc'])
+
+
+def format_hit(hit):
+    return 'Watchpoint: %s of x%04X by x%04X, x%04X -> x%04X' % (hit.kind, hit.address, hit.pc, hit.old, hit.new)
+
+
+# Watchpoint index, flags per address checked by the load and store handlers
+class Watchpoints(object):
+    def __init__(self):
+        self.flags = bytearray(nrow)
+        self.watches = []
+        self.last_hit = None
+
+    def __iter__(self):
+        return iter(self.watches)
+
+    def __len__(self):
+        return len(self.watches)
+
+    # Watch [start, stop), by default only for writes
+    def add(self, start, stop=None, kinds=WATCH_WRITE, condition=None):
+        if stop is None:
+            stop = start + 1
+        watch = Watch(start, stop, kinds, condition)
+        self.watches.append(watch)
+        for address in range(start, stop):
+            self.flags[address] |= kinds
+        return watch
+
+    def remove(self, watch):
+        self.watches.remove(watch)
+        self.flags[watch.start:watch.stop] = bytearray(watch.stop - watch.start)
+        for other in self.watches:  # Restore the flags of overlapping watches
+            for address in range(max(other.start, watch.start), min(other.stop, watch.stop)):
+                self.flags[address] |= other.kinds
+
+    def clear(self):
+        self.flags[:] = bytearray(nrow)
+        del self.watches[:]
+        self.last_hit = None
+
+    # Called by a handler when it touches a flagged address, returns True if execution should stop
+    def hit(self, address, kind, old, new, pc, registers, memory):
+        stop = False
+        for watch in self.watches:
+            if address in watch and watch.kinds & kind:
+                watch.hits += 1
+                if watch.condition is None or watch.condition(registers, memory, watch.hits, old, new, address):
+                    stop = True
+        if stop:
+            self.last_hit = WatchHit(address, 'write' if kind == WATCH_WRITE else 'read', old, new, pc)
+        return stop
+
+
+# Parse an address written as x3000, #12288 or 12288
+def parse_address(text):
+    text = text.strip()
+    if text[0] in 'xX':
+        return int(text[1:], 16)
+    if text[0] == '#':
+        return int(text[1:], 10)
+    return int(text, 10)
+
+
+# Parse a breakpoint written as ADDRESS[ if CONDITION], returns (address, ignore_count, condition)
+def parse_breakpoint(text):
+    text, condition = split_condition(text)
+    return parse_address(text), 0, condition
+
+
+# Parse a watchpoint written as ADDRESS[-ADDRESS][:rw][ if CONDITION], returns (start, stop, kinds, condition)
+def parse_watch(text):
+    text, condition = split_condition(text)
+    kinds = WATCH_WRITE
+    if ':' in text:
+        text, kind_text = text.split(':', 1)
+        kinds = 0
+        if 'r' in kind_text:
+            kinds |= WATCH_READ
+        if 'w' in kind_text:
+            kinds |= WATCH_WRITE
+        if kinds == 0:
+            raise ValueError("Watchpoint needs r, w or rw")
+    if '-' in text:
+        first, last = text.split('-', 1)
+        start, stop = parse_address(first), parse_address(last) + 1
+    else:
+        start = parse_address(text)
+        stop = start + 1
+    if not 0 <= start < stop <= nrow:
+        raise ValueError("Watchpoint range out of memory")
+    return start, stop, kinds, condition
+
+
+def split_condition(text):
+    match = re.match(r'^(.*?)\s+if\s+(.*)$', text.strip())
+    if match is None:
+        return text, None
+    return match.group(1), Condition(match.group(2))
+
+
+#
+# Conditions, e.g. "R0 == x41 && mem[x4000] > 3" or "hits > 100"
+# They are translated to a Python lambda once, so a hit only costs a function call.
+# Values are unsigned 16 bit like the memory display, signed(...) reads them as two's complement.
+#   R0-R7, PC, IR, PSR, CC   machine state
+#   mem[...]                 memory contents
+#   hits                     times the breakpoint/watchpoint was reached, this one included
+#   old, new, address        the access that triggered a watchpoint
+#   x41 (hex), #65, #-1, 65  numbers, #-1 means xFFFF
+#   && || ! == != < > <= >= + - * & | ^ ~ << >> ( )
+#
+
+condition_token = re.compile(r'''\s*(?:
+    (?P<register>[rR][0-7])\b |
+    (?P<hex>[xX][0-9a-fA-F]+)\b |
+    (?P<name>[A-Za-z_]\w*) |
+    (?P<decimal>\#-?[0-9]+|[0-9]+)\b |
+    (?P<operator>&&|\|\||==|!=|<=|>=|<<|>>|[<>!()\[\]+\-*&|^~])
+    )''', re.VERBOSE)
+
+condition_names = {'pc': 'I.PC', 'ir': 'I.IR', 'psr': 'I.PSR', 'cc': 'I.CC', 'hits': 'hits',
+                   'old': 'old', 'new': 'new', 'address': 'address', 'signed': 'signed', 'mem': 'M'}
+condition_operators = {'&&': ' and ', '||': ' or ', '!': ' not ', '[': '[0xFFFF & (', ']': ')]'}
+
+
+def signed(value):
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+# Translate a condition into the body of a Python expression
+def translate_condition(text):
+    pieces = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = condition_token.match(text, position)
+        if match is None or match.end() == position:
+            raise ValueError("Invalid condition at: " + text[position:])
+        position = match.end()
+        kind = match.lastgroup
+        token = match.group(kind)
+        if kind == 'register':
+            pieces.append('I[%s]' % token[1])
+        elif kind == 'name':
+            if token.lower() not in condition_names:
+                raise ValueError("Unknown name in condition: " + token)
+            pieces.append(condition_names[token.lower()])
+        elif kind == 'hex':
+            pieces.append(str(int(token[1:], 16)))
+        elif kind == 'decimal':
+            pieces.append(str(int(token.lstrip('#'), 10) & 0xFFFF))
+        else:
+            pieces.append(condition_operators.get(token, ' ' + token + ' '))
+    return ''.join(pieces)
+
+
+# A parsed condition, called with the machine state and returning whether it holds
+class Condition(object):
+    def __init__(self, text):
+        self.text = text.strip()
+        source = 'lambda I, M, hits, old=0, new=0, address=0: %s' % translate_condition(text)
+        try:
+            self.function = eval(compile(source, '<condition>', 'eval'), {'__builtins__': {}, 'signed': signed})
+        except SyntaxError:
+            raise ValueError("Invalid condition: " + text)
+
+    def __call__(self, registers, memory, hits, old=0, new=0, address=0):
+        return self.function(registers, memory, hits, old, new, address)
+
+    def __str__(self):
+        return self.text
@@ -0,0 +1,202 @@
+#
+# Memory mapped devices, in the device page xFE00-xFFFF
+#
+# Loads and stores into the device page go through a DeviceBus, a table with a read and a write
+# handler slot for every address in it. Addresses no device claims behave like memory, and loads
+# and stores below the page never look at the table. Device registers still live in memory, so
+# the GUI, snapshots and the undo history see them like any other word.
+#
+# Devices that interrupt have enabled() and request() for the interrupt controller (see interrupts.py),
+# request() returns the (priority, vector) they want while their interrupt is enabled and ready.
+#
+
+# Useful memory locations
+KBSR = 0xFE00
+KBDR = 0xFE02
+DSR = 0xFE04
+DDR = 0xFE06
+TMR = 0xFE08  # Timer status: bit 15 is set every TMI instructions, bit 14 enables its interrupt
+TMI = 0xFE0A  # Timer interval in instructions, 0 stops the timer
+TMC = 0xFE0C  # Instructions left until the timer fires
+MCR = 0xFFFE
+
+device_page = 0xFE00  # Memory mapped device registers start here
+page_size = 0x10000 - device_page
+
+
+class DeviceBus(object):
+    def __init__(self, memory):
+        self.memory = memory
+        self.readers = [None] * page_size  # Indexed by address - device_page
+        self.writers = [None] * page_size
+
+    # Hand loads and/or stores of address to a device
+    # read(address) returns the word loaded, write(address, value) stores value
+    def attach(self, address, read=None, write=None):
+        if read is not None:
+            self.readers[address - device_page] = read
+        if write is not None:
+            self.writers[address - device_page] = write
+
+    def detach(self, address):
+        self.readers[address - device_page] = None
+        self.writers[address - device_page] = None
+
+    # Load from an address in the device page
+    def read(self, address):
+        reader = self.readers[address - device_page]
+        if reader is None:
+            return self.memory[address]
+        return reader(address)
+
+    # Store to an address in the device page
+    def write(self, address, value):
+        writer = self.writers[address - device_page]
+        if writer is None:
+            self.memory[address] = value
+        else:
+            writer(address, value)
+
+
+# KBSR bit 15 is set while a key is waiting in KBDR, reading KBDR clears it, bit 14 enables its interrupt
+# Keys come from memory.keyboard (see keyboard.KeyboardInput), only when the program looks for one
+# or waits for its interrupt
+class Keyboard(object):
+    priority = 4
+    vector = 0x80
+
+    def __init__(self, machine):
+        self.machine = machine
+
+    def attach(self, bus):
+        bus.attach(KBSR, read=self.read_status, write=self.write_status)
+        bus.attach(KBDR, read=self.read_data)
+
+    # If no key is waiting in KBDR, take the next one typed
+    def poll(self):
+        memory = self.machine.memory
+        if memory[KBSR] & 0x8000:
+            return
+        key = memory.keyboard.get()
+        if key is None:
+            return
+        history = self.machine.history
+        if history is not None:
+            history.record_word(KBSR, memory[KBSR])
+            history.record_word(KBDR, memory[KBDR])
+            history.record_key(key)
+        memory[KBSR] = memory[KBSR] | 0x8000
+        if key == 0x0D:
+            key = 0x0A
+        memory[KBDR] = key
+
+    def read_status(self, address):
+        self.poll()
+        return self.machine.memory[KBSR]
+
+    def read_data(self, address):
+        self.poll()
+        memory = self.machine.memory
+        value = memory[KBDR]
+        if self.machine.history is not None:
+            self.machine.history.record_word(KBSR, memory[KBSR])
+        memory[KBSR] = memory[KBSR] & 0x7FFF
+        return value
+
+    def write_status(self, address, value):
+        self.machine.memory[KBSR] = value
+        self.machine.interrupts.update()
+
+    def enabled(self):
+        return self.machine.memory[KBSR] & 0x4000
+
+    def request(self):
+        memory = self.machine.memory
+        if memory[KBSR] & 0x4000:
+            self.poll()
+            if memory[KBSR] & 0x8000:
+                return self.priority, self.vector
+        return None
+
+
+# Characters stored in DDR are displayed at once, so DSR is always ready
+class Display(object):
+    def __init__(self, machine):
+        self.machine = machine
+
+    def attach(self, bus):
+        bus.attach(DDR, write=self.write_data)
+
+    def write_data(self, address, value):
+        self.machine.memory[DDR] = value
+        if value < 256:
+            self.machine.output(chr(value))
+
+
+# Counts executed instructions, setting TMR bit 15 every TMI of them, reading TMR clears it
+# Only counts while the interrupt controller is armed, which a non-zero TMI makes it
+class Timer(object):
+    priority = 5
+    vector = 0x81
+
+    def __init__(self, machine):
+        self.machine = machine
+
+    def attach(self, bus):
+        bus.attach(TMR, read=self.read_status, write=self.write_status)
+        bus.attach(TMI, write=self.write_interval)
+
+    # Fire every interval instructions, with interrupt also interrupting, 0 stops the timer
+    def start(self, interval, interrupt=True):
+        memory = self.machine.memory
+        memory[TMR] = 0x4000 if interrupt else 0
+        memory[TMI] = memory[TMC] = interval
+        self.machine.interrupts.update()
+
+    def read_status(self, address):
+        memory = self.machine.memory
+        value = memory[TMR]
+        if value & 0x8000:
+            self.record(TMR)
+            memory[TMR] = value & 0x7FFF
+        return value
+
+    def write_status(self, address, value):
+        self.machine.memory[TMR] = value
+        self.machine.interrupts.update()
+
+    # A new interval starts counting at once
+    def write_interval(self, address, value):
+        memory = self.machine.memory
+        memory[TMI] = value
+        self.record(TMC)
+        memory[TMC] = value
+        self.machine.interrupts.update()
+
+    def enabled(self):
+        memory = self.machine.memory
+        return memory[TMI] or memory[TMR] & 0x4000
+
+    # Count the instruction just executed
+    def tick(self):
+        memory = self.machine.memory
+        self.record(TMC)
+        count = memory[TMC]
+        if count > 1:
+            memory[TMC] = count - 1
+        else:
+            memory[TMC] = memory[TMI]
+            self.record(TMR)
+            memory[TMR] = memory[TMR] | 0x8000
+
+    def request(self):
+        memory = self.machine.memory
+        if memory[TMI]:
+            self.tick()
+        if memory[TMR] & 0xC000 == 0xC000:
+            return self.priority, self.vector
+        return None
+
+    def record(self, address):
+        if self.machine.history is not None:
+            self.machine.history.record_word(address, self.machine.memory[address])
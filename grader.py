@@ -0,0 +1,153 @@
+#
+# Batch grader: runs every submission against every test on a pool of worker processes
+#
+# Layout, as in instructions/Quiz:
+#   submissions/NAME.obj     one program per student
+#   tests/TEST.in            fed to the keyboard (optional, no input if missing)
+#   tests/TEST.out           expected console output
+# Files given with extra are loaded before each submission, e.g. a shared data.obj.
+# Each worker loads the OS once and restores a snapshot of it between jobs.
+# With a trace directory, every job also writes SUBMISSION-TEST.trace.gz there (see tracer.py).
+# Results are dicts, printed by lc3.py as JSON lines.
+#
+
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import machine
+
+default_max_steps = 10 ** 6  # Programs waiting for input that never comes would spin forever
+
+# State of the current worker process, set by init_worker
+worker = None
+
+
+class Worker(object):
+    def __init__(self, os_file, engine, backend, max_steps, trace_dir=None):
+        self.machine = machine.Machine(backend=backend, engine=engine)
+        self.machine.boot((), os_file)
+        self.boot_snapshot = self.machine.snapshot()
+        self.max_steps = max_steps
+        self.trace_dir = trace_dir
+
+    def grade(self, job):
+        submission, programs, test_name, test_input, expected = job
+        lc3 = self.machine
+        start = time.time()
+        result = {'submission': submission, 'test': test_name}
+        try:
+            lc3.restore(self.boot_snapshot)
+            lc3.load_programs(programs)
+            lc3.feed(test_input)
+            if self.trace_dir is not None:
+                name = '%s-%s.trace.gz' % (os.path.splitext(submission)[0], test_name)
+                lc3.record_trace(os.path.join(self.trace_dir, name))
+            output = []
+            run = lc3.run(max_steps=self.max_steps, output=output.append)
+            output = ''.join(output)
+            result.update(passed=run.reason == machine.HALTED and normalize(output) == normalize(expected),
+                          reason=run.reason, steps=run.steps)
+            if not result['passed']:
+                result['output'] = output.decode('latin-1')  # Any byte a program prints, JSON needs unicode
+        except Exception as e:  # A broken submission must not take the whole batch down
+            result.update(passed=False, reason='error', steps=0,
+                          error=('%s: %s' % (type(e).__name__, e)).decode('latin-1'))
+        finally:
+            lc3.stop_trace()
+        result['time'] = round(time.time() - start, 6)
+        return result
+
+
+def init_worker(os_file, engine, backend, max_steps, trace_dir=None):
+    global worker
+    worker = Worker(os_file, engine, backend, max_steps, trace_dir)
+
+
+def grade_job(job):
+    return worker.grade(job)
+
+
+# Line endings and trailing whitespace don't count
+def normalize(text):
+    return '\n'.join(line.rstrip() for line in text.replace('\r\n', '\n').split('\n')).rstrip()
+
+
+def read(fname):
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+# Returns (name, input, expected output) for every .out file in tests_dir
+def find_tests(tests_dir):
+    tests = []
+    for expected_file in sorted(glob.glob(os.path.join(tests_dir, '*.out'))):
+        name = os.path.splitext(expected_file)[0]
+        test_input = read(name + '.in') if os.path.exists(name + '.in') else ''
+        tests.append((os.path.basename(name), test_input, read(expected_file)))
+    return tests
+
+
+# One job per submission and test
+def create_jobs(submissions_dir, tests_dir, extra=()):
+    tests = find_tests(tests_dir)
+    jobs = []
+    for submission in sorted(glob.glob(os.path.join(submissions_dir, '*.obj'))):
+        programs = list(extra) + [submission]
+        for test_name, test_input, expected in tests:
+            jobs.append((os.path.basename(submission), programs, test_name, test_input, expected))
+    return jobs
+
+
+# Yields a result for every job as soon as it finishes, in no particular order
+def grade(jobs, processes=None, os_file=machine.default_os_file, engine='interpreter',
+          backend='int', max_steps=default_max_steps, trace_dir=None):
+    if trace_dir is not None and not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    initargs = (os_file, engine, backend, max_steps, trace_dir)
+    if processes == 1:  # No pool, easier to debug
+        init_worker(*initargs)
+        for job in jobs:
+            yield grade_job(job)
+        return
+    pool = multiprocessing.Pool(processes, init_worker, initargs)
+    try:
+        chunksize = max(1, len(jobs) // (4 * (processes or multiprocessing.cpu_count())))
+        for result in pool.imap_unordered(grade_job, jobs, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# One result as a JSON line, a result that can't be written is reported instead of stopping the batch
+def to_json(result):
+    try:
+        return json.dumps(result, sort_keys=True)
+    except (TypeError, ValueError) as e:
+        return json.dumps({'submission': repr(result.get('submission')), 'test': repr(result.get('test')),
+                           'passed': False, 'reason': 'error', 'error': 'Unwritable result: %r' % e},
+                          sort_keys=True)
+
+
+# Used by "python -m lc3 grade", prints a JSON line per job and a summary to stderr
+def main(args):
+    jobs = create_jobs(args.submissions, args.tests, args.load)
+    if not jobs:
+        sys.stderr.write('Nothing to grade: need .obj files in %s and .out files in %s\n'
+                         % (args.submissions, args.tests))
+        return 1
+    start = time.time()
+    passed = 0
+    for result in grade(jobs, args.jobs, args.os, args.engine, args.backend, args.max_steps, args.trace):
+        passed += result['passed']
+        sys.stdout.write(to_json(result) + '\n')
+    sys.stdout.flush()
+    sys.stderr.write('%d/%d passed in %.3fs\n' % (passed, len(jobs), time.time() - start))
+    return 0
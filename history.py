@@ -0,0 +1,123 @@
+#
+# Undo log for reverse execution
+#
+# Every executed instruction adds one record holding what it may change: the old PC and PSR
+# (CC is its low bits) and the old value of the register it writes, R0 if it writes none (putting
+# back a register that didn't change does nothing). Memory words written by the store handlers
+# and the devices, keys taken from the keyboard queue, and the HALT trap clearing the machine's
+# ON flag add records of their own after it. Undoing an instruction pops records back to and
+# including its instruction record. Taking an interrupt is undone the same way, as if it were an
+# instruction of its own.
+#
+# A record is two 32 bit words appended to two arrays, as Python 2 arrays have no 64 bit type on
+# every platform. Runs call trim every capacity instructions or so, keeping the last capacity
+# records or a few less, so the log always starts at an instruction. Machine.interpret appends its
+# instruction records itself, as record does. Console output can't be taken back.
+#
+
+from array import array
+
+default_capacity = 1 << 20  # Records kept by trim, 8 bytes each
+
+# Record layout, low word:
+#   bits 0-15   PC of an instruction, or address of a word
+#   bits 16-31  PSR before an instruction
+# High word:
+#   bits 0-15   old value of the register or word, or the key
+#   bits 16-18  register index
+#   bits 19-23  kind
+INSTRUCTION = 1 << 19
+WORD = 2 << 19
+KEY = 4 << 19
+HALT = 8 << 19  # The machine was still ON before this HALT trap
+INTERRUPT = 16 << 19  # Like INSTRUCTION, for an interrupt taken before the instruction at the PC
+kinds = 0b11111 << 19
+steps = INSTRUCTION | INTERRUPT  # Kinds that start what one undo takes back
+
+
+class History(object):
+    def __init__(self, capacity=default_capacity):
+        self.capacity = capacity
+        self.low = array('I')
+        self.high = array('I')
+
+    def __len__(self):
+        return len(self.high)
+
+    def clear(self):
+        del self.low[:]
+        del self.high[:]
+
+    # Forget all but the last capacity records, starting at the instruction they begin with
+    def trim(self):
+        high = self.high
+        cut = len(high) - self.capacity
+        if cut > 0:
+            while cut < len(high) and not high[cut] & steps:
+                cut += 1
+            del self.low[:cut]
+            del high[:cut]
+
+    # Called before an instruction executes, pc is its address
+    def record(self, pc, entry, registers):
+        register = entry[11]
+        self.low.append(pc | registers.PSR << 16)
+        self.high.append(registers.registers[register] | register << 16 | INSTRUCTION)
+
+    # Called before an interrupt is taken, it switches the stack so R6 is saved
+    def record_interrupt(self, pc, registers):
+        self.low.append(pc | registers.PSR << 16)
+        self.high.append(registers.registers[6] | 6 << 16 | INTERRUPT)
+
+    # Called before a memory word is overwritten
+    def record_word(self, address, old):
+        self.low.append(address)
+        self.high.append(int(old) | WORD)
+
+    # Called when a key is taken from the keyboard queue
+    def record_key(self, key):
+        self.low.append(0)
+        self.high.append(key | KEY)
+
+    # Called when the HALT trap turns the machine off
+    def record_halt(self):
+        self.low.append(0)
+        self.high.append(HALT)
+
+    # Undo the last instruction, returns the memory addresses it restored, or None if there is nothing to undo
+    def undo(self, machine):
+        memory = machine.memory
+        registers = machine.registers
+        low = self.low
+        high = self.high
+        if not high or not high[0] & steps:  # Nothing, or not a whole instruction to go back to
+            return None
+        restored = []
+        while True:
+            place = low.pop()
+            record = high.pop()
+            kind = record & kinds
+            value = int(record & 0xFFFF)
+            if kind == WORD:
+                memory[place] = value
+                memory.mark_dirty(place)
+                restored.append(place)
+            elif kind == KEY:
+                memory.keyboard.unget(value)
+            elif kind == HALT:
+                machine.ON = True
+            else:
+                registers[int(record >> 16) & 0b111] = value
+                registers.PC = int(place & 0xFFFF)
+                registers.IR = self.previous_instruction(memory)
+                registers.PSR = int(place >> 16)
+                registers.CC = registers.PSR & 0b111
+                return restored
+
+    # The word of the instruction before the last one recorded, what IR held before it ran
+    def previous_instruction(self, memory):
+        high = self.high
+        for i in xrange(len(high) - 1, -1, -1):
+            if high[i] & kinds == INSTRUCTION:
+                return memory[int(self.low[i] & 0xFFFF)]
+        return 0
@@ -3,6 +3,8 @@
 # a list of the separated parts
 #
 
+import numpy as np
+
 def parse_any(inst):
     opcode = inst >> 12
     str_op = parse_op(opcode)
@@ -236,4 +238,111 @@ def parse_op(opcode):
     return ['BR', 'ADD', 'LD', 'ST',
             'JSR', 'AND', 'LDR', 'STR',
             'RTI', 'NOT', 'LDI', 'STI',
-            'RET', 'NOP', 'LEA', 'TRAP'][opcode]
\ No newline at end of file
+            'RET', 'NOP', 'LEA', 'TRAP'][opcode]
+
+#
+# Predecoding: every word is split into all of its possible fields up front,
+# so the simulator never has to re-parse an instruction it has seen before.
+# Entry layout: (opcode, DR, SR1, SR2, imm, imm5, offset6, offset9, offset11,
+#                trap_vec, bit_11, written, inst), offsets already sign extended,
+#                written is the register the instruction writes, 0 if none (see history.py)
+#
+
+# Register each opcode writes, indexed by opcode, -1 for its DR field
+written_register = [0] * 16
+written_register[0b0100] = written_register[0b1111] = 7  # JSR/JSRR and TRAP write R7
+written_register[0b1000] = 6  # RTI pops R6
+for opcode in (0b0001, 0b0101, 0b1001, 0b0010, 0b1010, 0b0110, 0b1110):  # ADD AND NOT LD LDI LDR LEA
+    written_register[opcode] = -1
+
+
+def decode(inst):
+    word = inst & 0xFFFF
+    written = written_register[word >> 12]
+    return (word >> 12,
+            (word >> 9) & 0b111,
+            (word >> 6) & 0b111,
+            word & 0b111,
+            (word >> 5) & 0b1,
+            sign_extend(word & 0b11111, 5),
+            sign_extend(word & 0b111111, 6),
+            sign_extend(word & 0b111111111, 9),
+            sign_extend(word & 0b11111111111, 11),
+            word & 0b11111111,
+            (word >> 11) & 0b1,
+            (word >> 9) & 0b111 if written < 0 else written,
+            inst)
+
+
+# Vectorized version of decode, builds the entries for a whole block of memory at once
+def decode_table(words):
+    words = np.asarray(words)
+    word = words.astype(np.int32) & 0xFFFF
+    fields = [word >> 12,
+              (word >> 9) & 0b111,
+              (word >> 6) & 0b111,
+              word & 0b111,
+              (word >> 5) & 0b1,
+              sign_extend_array(word & 0b11111, 5),
+              sign_extend_array(word & 0b111111, 6),
+              sign_extend_array(word & 0b111111111, 9),
+              sign_extend_array(word & 0b11111111111, 11),
+              word & 0b11111111,
+              (word >> 11) & 0b1,
+              written_field(word),
+              words]
+    return zip(*[field.tolist() for field in fields])
+
+
+def written_field(word):
+    written = np.array(written_register)[word >> 12]
+    return np.where(written < 0, (word >> 9) & 0b111, written)
+
+
+def sign_extend(val, bits):
+    if (val & (1 << (bits - 1))) != 0:  # if sign bit is set
+        val = val - (1 << bits)  # compute negative value
+    return val  # return positive value as is
+
+
+def sign_extend_array(vals, bits):
+    sign_bit = 1 << (bits - 1)
+    return (vals ^ sign_bit) - sign_bit
+
+#
+# Disassembly as shown in the memory table, e.g. "LD R0, x3005" or "BRnzp LOOP"
+# The text of a word only depends on its value, except for a PC-relative target, so every word
+# is formatted once into the text before its target plus the target's offset, and the target
+# (or its label) is appended per address.
+#
+
+disassembly = [None] * 65536  # Word -> (text before the target, offset or None), filled as words are seen
+
+
+def disassemble_word(inst):
+    word = int(inst) & 0xFFFF
+    cached = disassembly[word]
+    if cached is None:
+        parts = parse_any(word)
+        if not parts:  # Reserved opcode, shown as the data it has to be
+            cached = disassembly[word] = ('.FILL x%04X' % word, None)
+            return cached
+        offset = None
+        if len(parts) > 1 and isinstance(parts[-1], (int, long)):  # BR, JSR, LD, LDI, LEA, ST, STI
+            offset = sign_extend(parts.pop(), 11 if word >> 12 == 0b0100 else 9)
+            parts.append('')
+        cached = disassembly[word] = (str(parts[0]) + ' ' + ', '.join(str(part) for part in parts[1:]), offset)
+    return cached
+
+
+# Disassemble the word at address, naming its target from labels ({address: label}) where possible
+def disassemble(address, inst, labels=None):
+    text, offset = disassemble_word(inst)
+    if offset is None:
+        return text
+    if labels is None:
+        labels = {}
+    target = (address + 1 + offset) & 0xFFFF
+    if target in labels:
+        return text + labels[target]
+    return text + 'x%04X' % target
@@ -0,0 +1,97 @@
+#
+# Interrupt controller: takes device interrupts between instructions, on the simulation's own thread
+#
+# After every instruction, while armed, each source device (see devices.py) is asked for the
+# interrupt it wants, and interrupts queued with raise_interrupt are added. The most urgent one
+# is taken if its priority is above the one in PSR bits 10-8: PSR and PC are pushed on the
+# supervisor stack (switching to it from user mode), PSR gets the new priority in supervisor mode,
+# and the PC jumps through the vector table at x0100-x01FF. RTI undoes this.
+# Nothing is armed unless a device has its interrupt enabled or the timer runs, so programs that
+# don't use interrupts only pay for checking one flag.
+#
+
+from collections import deque
+
+vector_table = 0x0100
+default_ssp = 0x3000  # Supervisor stack, grows down from the start of user programs
+
+
+class InterruptController(object):
+    # sources are the devices that can interrupt, with enabled() and request()
+    def __init__(self, machine, sources):
+        self.machine = machine
+        self.sources = sources
+        self.requests = deque()  # (priority, vector) raised once with raise_interrupt
+        self.saved_ssp = default_ssp  # The stack pointer of the mode not running
+        self.saved_usp = 0
+        self.armed = False  # The run loops only call step while this is set
+
+    def reset(self):
+        self.requests.clear()
+        self.saved_ssp = default_ssp
+        self.saved_usp = 0
+        self.update()
+
+    # Recheck whether anything can interrupt, called when a device is enabled or disabled
+    def update(self):
+        self.armed = bool(self.requests) or any(source.enabled() for source in self.sources)
+
+    # Queue an interrupt, it is taken once its priority is above the machine's
+    # Safe to call from another thread
+    def raise_interrupt(self, vector, priority=4):
+        self.requests.append((priority & 0b111, vector & 0xFF))
+        self.armed = True
+
+    # Called after an instruction executes, returns True if an interrupt was taken
+    def step(self):
+        best = None
+        for source in self.sources:
+            request = source.request()  # Also lets the timer count
+            if request is not None and (best is None or request[0] > best[0]):
+                best = request
+        queued = None
+        for request in self.requests:
+            if best is None or request[0] > best[0]:
+                best = queued = request
+        if best is None or best[0] <= (self.machine.registers.PSR >> 8) & 0b111:
+            return False
+        if queued is not None:
+            self.requests.remove(queued)
+            self.update()
+        self.enter(*best)
+        return True
+
+    # Start the service routine of vector, running at priority
+    def enter(self, priority, vector):
+        machine = self.machine
+        memory = machine.memory
+        registers = machine.registers
+        history = machine.history
+        pc = registers.PC
+        psr = registers.PSR
+        if history is not None:
+            history.record_interrupt(pc, registers)
+        if psr & 0x8000:  # From user mode, switch to the supervisor stack
+            self.saved_usp = registers[6]
+            registers[6] = self.saved_ssp
+        for value in (psr, pc):
+            sp = (registers[6] - 1) & 0xFFFF
+            if history is not None:
+                history.record_word(sp, memory[sp])
+            memory[sp] = value
+            memory.mark_dirty(sp)
+            registers[6] = sp
+        registers.PSR = priority << 8
+        registers.CC = 0
+        registers.PC = memory[vector_table + vector]
+        if machine.profiler is not None:
+            machine.profiler.enter(registers.PC, pc)
+
+    # State for Machine.snapshot, device registers are saved with memory
+    def save(self):
+        return tuple(self.requests), self.saved_ssp, self.saved_usp
+
+    def restore(self, state):
+        requests, self.saved_ssp, self.saved_usp = state
+        self.requests = deque(requests)
+        self.update()
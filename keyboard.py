@@ -0,0 +1,104 @@
+#
+# Keyboard input: keys waiting to be read by the simulated keyboard (KBSR/KBDR)
+#
+# Typed keys go into a deque, whose append and popleft are atomic, so the GUI thread can type while
+# the machine runs without any locking. Scripted input (a string or a file) is queued behind them
+# and read a chunk at a time as the program consumes it, so large inputs are streamed, never
+# dropped and never block. The machine only asks for a key when the program reads KBSR or KBDR.
+#
+
+from collections import deque
+
+chunk_size = 1 << 16
+
+
+# A string or a file fed to the keyboard, read from position on
+class ScriptedInput(object):
+    def __init__(self, text=None, fname=None, position=0):
+        self.text = text
+        self.fname = fname
+        self.position = position
+        self.file = None
+
+    # Next chunk of input, empty at the end
+    def read(self):
+        if self.text is not None:
+            chunk = self.text[self.position:self.position + chunk_size]
+        else:
+            if self.file is None:  # Opened once and read in order, so pipes work too
+                self.file = open(self.fname, 'rb')
+                if self.position:  # Restored from a snapshot, only regular files can skip ahead
+                    self.file.seek(self.position)
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                self.file.close()
+        self.position += len(chunk)
+        return chunk
+
+    # Where it is, for KeyboardInput.save
+    def state(self):
+        return self.text, self.fname, self.position
+
+
+class KeyboardInput(object):
+    def __init__(self):
+        self.keys = deque()  # Key codes ready to be read
+        self.scripts = deque()  # ScriptedInputs read once keys runs out
+
+    def __len__(self):
+        return len(self.keys)
+
+    # True if there is nothing left to read
+    def empty(self):
+        if self.keys:
+            return False
+        return not self.fill()
+
+    # Type a key, safe to call while the machine runs
+    def put(self, key):
+        self.keys.append(key)
+
+    # Queue text after everything already queued
+    def feed(self, text):
+        if self.scripts:
+            self.scripts.append(ScriptedInput(text))
+        else:
+            self.keys.extend(bytearray(text))
+
+    # Queue a file, read as the program consumes it
+    def feed_file(self, fname):
+        self.scripts.append(ScriptedInput(fname=fname))
+
+    # Next key, or None if there is none
+    def get(self):
+        keys = self.keys
+        if keys or self.fill():
+            return keys.popleft()
+        return None
+
+    # Put a key back in front, used when a read is undone
+    def unget(self, key):
+        self.keys.appendleft(key)
+
+    # Move the next chunk of scripted input into keys, returns False if there is none
+    def fill(self):
+        while self.scripts:
+            chunk = self.scripts[0].read()
+            if chunk:
+                self.keys.extend(bytearray(chunk))
+                return True
+            self.scripts.popleft()
+        return False
+
+    def clear(self):
+        self.keys.clear()
+        self.scripts.clear()
+
+    # State for Machine.snapshot, scripted input is saved by position and not read
+    def save(self):
+        return tuple(self.keys), [script.state() for script in self.scripts]
+
+    def restore(self, state):
+        keys, scripts = state
+        self.keys = deque(keys)
+        self.scripts = deque(ScriptedInput(*script) for script in scripts)
@@ -0,0 +1,134 @@
+#
+# Command line entry point for the simulator
+#   python -m lc3            starts the GUI
+#   python -m lc3 run ...    runs programs headless, without importing PyQt4
+#   python -m lc3 grade ...  grades a directory of submissions, see grader.py
+#   python -m lc3 trace ...  prints a trace written by run --trace, see tracer.py
+#
+
+import argparse
+import io
+import sys
+
+import debugger
+import grader
+import machine
+import storage
+import tracer
+
+output_buffer_size = 1 << 16
+os_help = 'Operating system, a text file with one binary word per line (default: the bundled LC3_OS.bin)'
+
+
+def run(args):
+    lc3 = machine.Machine(backend=args.backend, engine=args.engine, memory_file=args.memory_file)
+    lc3.boot(args.programs, args.os)
+    if args.input is not None:
+        lc3.feed_file(args.input)  # Streamed as the program reads it
+    for watch in args.watch:
+        lc3.memory.watchpoints.add(*watch)
+    for breakpoint in args.breakpoints:
+        lc3.memory.breakpoints.add(*breakpoint)
+    if args.trace is not None:
+        lc3.record_trace(args.trace)
+    if args.profile is not None:
+        lc3.start_profile()
+
+    stdout = io.BufferedWriter(io.FileIO(sys.stdout.fileno(), 'w', closefd=False), output_buffer_size)
+    try:
+        result = lc3.run(max_steps=args.max_steps, output=stdout.write)
+    finally:
+        stdout.flush()
+        lc3.stop_trace()
+
+    rate = result.steps / result.elapsed if result.elapsed > 0 else 0
+    sys.stderr.write('\n%d instructions in %.3fs (%.0f instructions/sec)\n' % (result.steps, result.elapsed, rate))
+    if result.reason == machine.WATCHPOINT:
+        sys.stderr.write(debugger.format_hit(lc3.memory.watchpoints.last_hit) + '\n')
+    elif result.reason == machine.BREAKPOINT:
+        sys.stderr.write('Breakpoint at x%04X, hit %d times\n' % (result.pc, lc3.memory.breakpoints.hits[result.pc]))
+    elif result.reason == machine.MAX_STEPS:
+        sys.stderr.write('Stopped after reaching --max-steps\n')
+    if args.profile is not None:
+        lc3.stop_profile().write(args.profile)
+    return 0 if result.reason == machine.HALTED else 1
+
+
+def print_trace(args):
+    count = 0
+    for record in tracer.read_trace(args.trace):
+        if count == args.limit:
+            break
+        sys.stdout.write(tracer.format_record(record) + '\n')
+        count += 1
+    return 0
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(prog='lc3', description='LC3 Simulator')
+    subparsers = arg_parser.add_subparsers(dest='command')
+
+    gui_parser = subparsers.add_parser('gui', help='Start the graphical simulator (default)')
+    gui_parser.add_argument('--os', default=machine.default_os_file, help=os_help)
+
+    run_parser = subparsers.add_parser('run', help='Run .obj files without the GUI')
+    run_parser.add_argument('programs', nargs='+', metavar='prog.obj', help='Object files to load')
+    run_parser.add_argument('--input', help='File fed to the keyboard as input')
+    run_parser.add_argument('--os', default=machine.default_os_file, help=os_help)
+    run_parser.add_argument('--max-steps', type=int, default=None,
+                            help='Stop after this many instructions')
+    run_parser.add_argument('--engine', choices=machine.engines, default='interpreter',
+                            help='Execute one instruction at a time, or translate basic blocks to Python')
+    run_parser.add_argument('--watch', action='append', default=[], type=debugger.parse_watch,
+                            metavar='"ADDR[-ADDR][:rw] [if COND]"',
+                            help='Stop when the address range is written (w, default) or read (r)')
+    run_parser.add_argument('--break', dest='breakpoints', action='append', default=[],
+                            type=debugger.parse_breakpoint, metavar='"ADDR [if COND]"',
+                            help='Stop at ADDR, optionally only when COND holds, e.g. "x3010 if R0 == x41"')
+    run_parser.add_argument('--backend', choices=sorted(storage.backends), default=storage.default_backend,
+                            help='Machine state storage: plain ints, NumPy arrays, or a NumPy array over a '
+                                 'copy-on-write mapping of the OS image')
+    run_parser.add_argument('--memory-file', help='Keep memory in this file, so other tools can map it while it runs')
+    run_parser.add_argument('--profile', metavar='FILE',
+                            help='Write where the program spent its instructions to this file, as JSON if it ends '
+                                 'in .json')
+    run_parser.add_argument('--trace', metavar='FILE',
+                            help='Write every executed instruction to this binary trace file, gzipped if it ends in .gz')
+
+    grade_parser = subparsers.add_parser('grade', help='Grade .obj submissions against tests, as JSON lines')
+    grade_parser.add_argument('submissions', help='Directory of .obj files, one per submission')
+    grade_parser.add_argument('tests', help='Directory of TEST.out expected outputs and optional TEST.in inputs')
+    grade_parser.add_argument('--load', action='append', default=[], metavar='file.obj',
+                              help='Also load this file before every submission, e.g. shared data')
+    grade_parser.add_argument('--os', default=machine.default_os_file, help=os_help)
+    grade_parser.add_argument('--jobs', type=int, default=None,
+                              help='Worker processes (default: one per CPU)')
+    grade_parser.add_argument('--max-steps', type=int, default=grader.default_max_steps,
+                              help='Fail a test after this many instructions')
+    grade_parser.add_argument('--engine', choices=machine.engines, default='interpreter')
+    grade_parser.add_argument('--backend', choices=sorted(storage.backends), default=storage.default_backend)
+    grade_parser.add_argument('--trace', metavar='DIR',
+                              help='Write a gzipped trace of every submission and test to this directory')
+
+    trace_parser = subparsers.add_parser('trace', help='Print a trace file written by run --trace')
+    trace_parser.add_argument('trace', help='Trace file')
+    trace_parser.add_argument('--limit', type=int, default=None, help='Only print this many instructions')
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        argv = ['gui']
+    args = arg_parser.parse_args(argv)
+
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'grade':
+        return grader.main(args)
+    if args.command == 'trace':
+        return print_trace(args)
+    import lc3_logic
+    lc3_logic.main(args.os)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
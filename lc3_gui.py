@@ -2,25 +2,25 @@ import sys
 
 from PyQt4 import QtGui, QtCore
 from PyQt4.QtCore import Qt
-from PyQt4.QtCore import QString, SIGNAL
+from PyQt4.QtCore import QString, QVariant, SIGNAL
 from PyQt4.QtGui import QTableWidgetItem, QTableWidget, QTextEdit, QLineEdit
 
 from lc3_logic import to_hex_string
 from lc3_logic import to_bin_string
 import lc3_logic
 
+import debugger
 import instruction_parser as parser
+import search
 from storage import Registers
 from storage import *
 
-from Queue import *
-import re
 
-KBSR = -512  # 0xFE00
-KBDR = -510  # 0xFE02
-DSR = -508  # 0xFE04
-DDR = -506  # 0xFE06
-MCR = -2  # 0xFFFE
+KBSR = 0xFE00
+KBDR = 0xFE02
+DSR = 0xFE04
+DDR = 0xFE06
+MCR = 0xFFFE
 
 default_origin = 0x3000
 
@@ -30,11 +30,11 @@ pc_color = QtGui.QColor(10, 206, 101)
 breakpoint_color = QtGui.QColor(249, 14, 69)
 default_color = QtGui.QColor(240, 240, 240)
 
-key_queue = Queue(maxsize=100)
+refresh_rate = 30  # Times per second the memory table and console are redrawn while running
+scrollback_lines = 5000  # Default number of lines the console keeps
 
 # TODO list:
 # Settings:
-#   - Follow PC
 #   - Auto-add labels to special memory addresses
 #   - Character queue buffer size
 # Fix auto-labeler
@@ -53,11 +53,14 @@ class Window(QtGui.QMainWindow):
         self.console_thread = None
         self.worker = RunHandler(self)
         self.modified_data = []
-        self.labeled_addresses = {}
+        self.follow_pc = False
 
-        self.mem_table = None
-        # TODO: make this faster
-        self.mem_table = MemoryTable(65536, 6)
+        # Stores only mark addresses dirty, this timer redraws them in batches while running
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setInterval(1000 / refresh_rate)
+        self.refresh_timer.timeout.connect(self.refresh_view)
+
+        self.mem_table = MemoryTable()
 
         self.reg_table = RegisterTable(4, 8)
         self.search_bar = SearchBar(self.mem_table)
@@ -109,6 +112,10 @@ class Window(QtGui.QMainWindow):
         loadProgramAction.setStatusTip('Load a .obj file into the simulator')
         loadProgramAction.triggered.connect(self.load_program)
 
+        loadOSAction = QtGui.QAction("Load &Operating System...", self)
+        loadOSAction.setStatusTip('Replace the operating system, the machine is reinitialized')
+        loadOSAction.triggered.connect(self.load_os)
+
         reinitializeAction = QtGui.QAction("&Reinitialize machine", self)
         reinitializeAction.setShortcut("Ctrl+R")
         reinitializeAction.setStatusTip('Clear the machine except for the operating system')
@@ -119,6 +126,10 @@ class Window(QtGui.QMainWindow):
         clearConsoleAction.setStatusTip('Clear the output of the console')
         clearConsoleAction.triggered.connect(self.clear_console)
 
+        scrollbackAction = QtGui.QAction("Console &Scrollback...", self)
+        scrollbackAction.setStatusTip('Set how many lines of output the console keeps')
+        scrollbackAction.triggered.connect(self.set_scrollback)
+
         exitAction = QtGui.QAction("&Exit Simulator", self)
         exitAction.setShortcut("Ctrl+Q")
         exitAction.setStatusTip('Exit out of the simulator')
@@ -134,11 +145,47 @@ class Window(QtGui.QMainWindow):
         stepAction.setStatusTip('Step one instruction forward from the current PC')
         stepAction.triggered.connect(lambda: self.run(True))
 
+        stepBackAction = QtGui.QAction("Step &Back", self)
+        stepBackAction.setShortcut("Ctrl+B")
+        stepBackAction.setStatusTip('Undo the last instruction')
+        stepBackAction.triggered.connect(lambda: self.run('back'))
+
+        reverseAction = QtGui.QAction("Re&verse Continue", self)
+        reverseAction.setShortcut("Ctrl+Shift+R")
+        reverseAction.setStatusTip('Run backwards to the previous breakpoint or write watchpoint')
+        reverseAction.triggered.connect(lambda: self.run('reverse'))
+
         stopAction = QtGui.QAction("&Stop", self)
         stopAction.setShortcut("Ctrl+P")
         stopAction.setStatusTip('Pause the simulation')
         stopAction.triggered.connect(self.suspend_process)
 
+        ignoreAction = QtGui.QAction("Breakpoint &Ignore Count...", self)
+        ignoreAction.setStatusTip('Let the breakpoint at the selected address be passed a number of times')
+        ignoreAction.triggered.connect(self.set_breakpoint_ignore)
+
+        conditionAction = QtGui.QAction("Breakpoint &Condition...", self)
+        conditionAction.setStatusTip('Only stop at the breakpoint at the selected address when a condition holds')
+        conditionAction.triggered.connect(self.set_breakpoint_condition)
+
+        watchAction = QtGui.QAction("Add &Watchpoint...", self)
+        watchAction.setStatusTip('Pause when an address or range is written or read')
+        watchAction.triggered.connect(self.add_watchpoint)
+
+        clearWatchAction = QtGui.QAction("Clear Watchpoints", self)
+        clearWatchAction.setStatusTip('Remove every watchpoint')
+        clearWatchAction.triggered.connect(self.clear_watchpoints)
+
+        followAction = QtGui.QAction("&Follow PC", self)
+        followAction.setCheckable(True)
+        followAction.setStatusTip('Keep the PC in view while the simulation runs')
+        followAction.toggled.connect(self.set_follow_pc)
+
+        profileAction = QtGui.QAction("&Profile", self)
+        profileAction.setCheckable(True)
+        profileAction.setStatusTip('Count where the program spends its instructions, saved when unchecked')
+        profileAction.toggled.connect(self.set_profiling)
+
         # Show the status bar tips
         self.statusBar()
 
@@ -146,48 +193,71 @@ class Window(QtGui.QMainWindow):
         mainMenu = self.menuBar()
         fileMenu = mainMenu.addMenu('&File')
         fileMenu.addAction(loadProgramAction)
+        fileMenu.addAction(loadOSAction)
         fileMenu.addAction(reinitializeAction)
         fileMenu.addAction(clearConsoleAction)
+        fileMenu.addAction(scrollbackAction)
         fileMenu.addAction(exitAction)
 
         # Execute menu setup
         executeMenu = mainMenu.addMenu('&Execute')
         executeMenu.addAction(runAction)
         executeMenu.addAction(stepAction)
+        executeMenu.addAction(stepBackAction)
+        executeMenu.addAction(reverseAction)
         executeMenu.addAction(stopAction)
+        executeMenu.addAction(ignoreAction)
+        executeMenu.addAction(conditionAction)
+        executeMenu.addAction(watchAction)
+        executeMenu.addAction(clearWatchAction)
+        executeMenu.addAction(followAction)
+        executeMenu.addAction(profileAction)
 
     # Open the file dialog to select program to load
     def load_program(self):
         self.file_dialog.file_open(self)
 
+    # Pick an OS file (one binary word per line, like LC3_OS.bin) and boot it
+    def load_os(self):
+        name = QtGui.QFileDialog.getOpenFileName(self, "Load Operating System", lc3_logic.os_file_name,
+                                                 "OS Files (*.bin *.txt);;All Files (*)")
+        if not name:
+            return
+        self.suspend_process()
+        try:
+            changed = lc3_logic.boot_os(str(name))
+        except (IOError, ValueError) as e:
+            self.statusBar().showMessage("Could not load operating system: " + str(e))
+            return
+        self.mem_table.update_rows(changed)
+        self.reinitialize_machine()
+        self.statusBar().showMessage("Loaded operating system " + str(name))
+
     # Clear the console
     def clear_console(self):
         self.console.clear()
 
+    def set_scrollback(self):
+        lines, ok = QtGui.QInputDialog.getInt(self, "Console Scrollback", "Lines to keep (0 for no limit):",
+                                              self.console.scrollback(), 0)
+        if ok:
+            self.console.set_scrollback(lines)
+
     # Reinitialize machine
     def reinitialize_machine(self, first_time=False):
         if not first_time:  # Initial time should not suspend process
             self.suspend_process()
             memory.paused = False
-        for i, register in enumerate(registers):
-            registers[i] = 0
+        rows = list(memory.breakpoints)
+        memory.breakpoints.clear()
+        self.mem_table.update_rows(rows)
+
+        # Back to the boot snapshot, only the rows that differ from it are redrawn
+        lc3_logic.machine.restore(lc3_logic.boot_snapshot)
+        self.mem_table.update_rows(memory.drain_dirty())
         self.set_pc(0x3000)
-        registers.IR = 0
-        registers.CC = 0b010
-        registers.PSR = 0x8000 + registers.CC
         self.reg_table.setData()
-
-        for row in memory.breakpoints:
-            self.mem_table.item(row, 0).setBackground(default_color)
-
-        memory.load_os()
-        for address in memory.modified_data:
-            if 0x514 <= address <= 0xFA00:  # If address is not in OS segment of memory, clear it to 0
-                self.mem_table.clearData(address)
-            else:  # Else set it to the correct OS data
-                self.mem_table.setDataRange(address, address + 1)
-        memory.reset_modified()
-        memory.key_queue = Queue(maxsize=100)
+        memory.output.clear()
         self.console.clear()
         self.mem_table.verticalScrollBar().setValue(registers.PC & bit_mask)
 
@@ -199,13 +269,99 @@ class Window(QtGui.QMainWindow):
     @QtCore.pyqtSlot()
     def update_gui_tables(self):
         self.reg_table.setData()
-        KBDR_gui = KBDR & bit_mask
-        KBSR_gui = KBSR & bit_mask
-        self.mem_table.setDataRange(KBDR_gui, KBDR_gui + 1)
-        self.mem_table.setDataRange(KBSR_gui, KBSR_gui + 1)
+        self.refresh_view()
+        if memory.watchpoints.last_hit is not None:
+            self.statusBar().showMessage(debugger.format_hit(memory.watchpoints.last_hit))
+            memory.watchpoints.last_hit = None
+        if lc3_logic.status is not None:
+            self.statusBar().showMessage(lc3_logic.status)
+            lc3_logic.status = None
+
+    # Redraw the memory changed since the last refresh and move the PC highlight
+    @QtCore.pyqtSlot()
+    def refresh_view(self):
+        self.console.output_text(memory.output.drain())
+        self.mem_table.update_rows(memory.drain_dirty())
+        self.move_pc_highlight()
+        if self.follow_pc:
+            self.jump_to_pc()
+
+    def move_pc_highlight(self):
+        if registers.PC != self.mem_table.memory_model.pc_row:
+            self.mem_table.highlight_pc(registers.PC)
+
+    # Set a breakpoint on the selected row that only stops after being hit a number of times
+    def set_breakpoint_ignore(self):
+        selected = self.mem_table.selectedIndexes()
+        if len(selected) == 0:
+            return
+        row = selected[0].row()
+        count, ok = QtGui.QInputDialog.getInt(self, "Ignore Count",
+                                              "Hits to ignore at " + to_hex_string(row) + ":", 0, 0)
+        if ok:
+            if row not in memory.breakpoints:
+                memory.breakpoints.add(row, count)
+                self.mem_table.update_rows([row])
+            else:
+                memory.breakpoints.set_ignore_count(row, count)
+        self.mem_table.clearSelection()
+
+    # Set a breakpoint on the selected row that only stops when a condition holds, empty to always stop
+    def set_breakpoint_condition(self):
+        selected = self.mem_table.selectedIndexes()
+        if len(selected) == 0:
+            return
+        row = selected[0].row()
+        text, ok = QtGui.QInputDialog.getText(self, "Breakpoint Condition",
+                                              "Stop at " + to_hex_string(row) + " if, e.g. R0 == x41 && hits > 3:")
+        self.mem_table.clearSelection()
+        if not ok:
+            return
+        condition = None
+        if str(text).strip():
+            try:
+                condition = debugger.Condition(str(text))
+            except ValueError as e:
+                self.statusBar().showMessage(str(e))
+                return
+        if row not in memory.breakpoints:
+            memory.breakpoints.add(row, condition=condition)
+            self.mem_table.update_rows([row])
+        else:
+            memory.breakpoints.set_condition(row, condition)
+
+    def add_watchpoint(self):
+        text, ok = QtGui.QInputDialog.getText(self, "Add Watchpoint",
+                                              "Address or range, e.g. x4000 or x4000-x40FF, add :r, :w or :rw\n"
+                                              "and optionally a condition, e.g. x4000:w if new > #10:")
+        if not ok or not str(text).strip():
+            return
+        try:
+            watch = memory.watchpoints.add(*debugger.parse_watch(str(text)))
+        except ValueError:
+            self.statusBar().showMessage("Invalid watchpoint: " + str(text))
+            return
+        self.statusBar().showMessage("Watching " + str(watch))
 
-        row = registers.PC & bit_mask
-        self.mem_table.item(row, 0).setBackground(pc_color)
+    def clear_watchpoints(self):
+        memory.watchpoints.clear()
+        self.statusBar().showMessage("Watchpoints cleared")
+
+    def set_follow_pc(self, checked):
+        self.follow_pc = checked
+
+    # Start profiling, or stop and save the profile (see profiler.py)
+    def set_profiling(self, checked):
+        if checked:
+            lc3_logic.machine.start_profile()
+            self.statusBar().showMessage("Profiling")
+            return
+        profiler = lc3_logic.machine.stop_profile()
+        name = QtGui.QFileDialog.getSaveFileName(self, "Save Profile", "profile.txt",
+                                                 "Text (*.txt);;JSON (*.json)")
+        if name:
+            profiler.write(str(name))
+            self.statusBar().showMessage("Saved profile of %d instructions to %s" % (profiler.count, name))
 
     # Used for stopping in the middle of an execution, activated by the STOP button
     def suspend_process(self):
@@ -213,24 +369,17 @@ class Window(QtGui.QMainWindow):
         memory.paused = True
 
     # Set the current PC pointer (blue box) to the correct instruction
-    # TODO: make methods for moving the PC pointer
     def set_pc(self, place=None):
-        row = registers.PC & bit_mask
-        self.mem_table.item(row, 0).setBackground(default_color)
-
         if not place:
             selected = self.mem_table.selectedIndexes()
             if len(selected) == 0:
-                self.mem_table.item(row, 0).setBackground(pc_color)
+                self.mem_table.highlight_pc(registers.PC & bit_mask)
                 return
-            index = selected[0]
-            registers.PC = index.row()
-            row = registers.PC & bit_mask
+            registers.PC = selected[0].row()
         else:
-            row = place
             registers.PC = place
 
-        self.mem_table.item(row, 0).setBackground(pc_color)
+        self.mem_table.highlight_pc(registers.PC & bit_mask)
         self.reg_table.setData()
         self.mem_table.setFocus()
         self.mem_table.clearSelection()
@@ -250,9 +399,9 @@ class Window(QtGui.QMainWindow):
 
         self.worker.moveToThread(self.thread)
         self.worker.finished.connect(self.thread.quit)
-        self.worker.ddr_updated.connect(self.console.output_char, Qt.BlockingQueuedConnection)
         self.worker.gui_updated.connect(self.update_gui_tables, Qt.BlockingQueuedConnection)
-        self.worker.memory_updated.connect(self.mem_table.update_memory_table, Qt.BlockingQueuedConnection)
+        self.worker.finished.connect(self.refresh_timer.stop)
+        self.refresh_timer.start()
 
         if step == 'run':
             self.thread.started.connect(self.worker.run_app)
@@ -261,6 +410,10 @@ class Window(QtGui.QMainWindow):
         elif step == 'over':
             memory.stepping_over = True
             self.thread.started.connect(self.worker.step_app)
+        elif step == 'back':
+            self.thread.started.connect(self.worker.step_back_app)
+        elif step == 'reverse':
+            self.thread.started.connect(self.worker.reverse_app)
 
         self.thread.finished.connect(self.thread.quit)
         self.thread.start()
@@ -275,6 +428,7 @@ class Console(QTextEdit):
         font.setPointSize(10)
         self.setFont(font)
         self.main = main
+        self.set_scrollback(scrollback_lines)
 
     # Override default keyPressEvent, update machine with correct information
     def keyPressEvent(self, event):
@@ -283,41 +437,29 @@ class Console(QTextEdit):
 
     def handle_input(self, event):
         if isinstance(event, QtGui.QKeyEvent) and len(event.text()) > 0:
-            self.send_key(event.text())
-            if (memory[KBSR] >> 14) & 1 == 1:
-                self.initiate_service_routine(self.main, 0x80)
+            self.send_key(event.text())  # A keyboard interrupt, if enabled, is taken by the running machine
 
-    @QtCore.pyqtSlot(str)
-    def output_char(self, char):
+    # Append a chunk of output drained from the machine
+    def output_text(self, text):
+        if not text:
+            return
         cursor = self.textCursor()
         cursor.movePosition(QtGui.QTextCursor.End)
-        cursor.insertText(char)
+        cursor.insertText(text)
         self.setTextCursor(cursor)
         self.ensureCursorVisible()
 
+    # Oldest lines are dropped past this many, 0 keeps everything
+    def set_scrollback(self, lines):
+        self.document().setMaximumBlockCount(lines)
+
+    def scrollback(self):
+        return self.document().maximumBlockCount()
+
     @staticmethod
     def send_key(event_txt):
         key = ord(str(event_txt))
-        memory.key_queue.put(key)
-
-    @staticmethod
-    def initiate_service_routine(main, vector):
-        old_PSR = registers.PSR
-        old_PC = registers.PC
-        main.mem_table.item(old_PC, 0).setBackground(default_color)
-
-        registers.PSR = registers.PSR & 0x7FFF  # Enter Supervisor Mode
-        registers.PSR = registers.PSR | 0x0400  # Set priority level to PL4
-        SSP = registers.registers[6]  # Set SSP to R6
-        registers.registers[6] -= 1  # Increment stack pointer
-        memory[SSP] = old_PSR  # Place PSR on top of Supervisor Stack
-        registers.registers[6] -= 1  # Increment stack pointer
-        SSP = registers.registers[6]  # Set SSP again
-        memory[SSP] = old_PC  # Place PC on top of Supervisor Stack
-        registers.PC = memory[vector + 0x100] - 1  # Jump to interrupt vector table location (always 0x0180)
-        changed = SSP & bit_mask
-        main.mem_table.setDataRange(changed - 2, changed)
-        main.reg_table.setData()
+        memory.keyboard.put(key)
 
 
 # Class for RunHandler, which handles all connections from GUI to logic
@@ -327,8 +469,6 @@ class RunHandler(QtCore.QObject):
     # Below are all signals associated with this worker
     #
     gui_updated = QtCore.pyqtSignal()  # Used when registers are updated
-    memory_updated = QtCore.pyqtSignal(int)  # Used to update memory gui
-    ddr_updated = QtCore.pyqtSignal(str)  # Used to update output gui
     started = QtCore.pyqtSignal()  # Used when started
     finished = QtCore.pyqtSignal()  # Used when done
 
@@ -339,16 +479,14 @@ class RunHandler(QtCore.QObject):
 
     # Start running the the code
     def run_app(self):
-        row = registers.PC & bit_mask
-        self.main.mem_table.item(row, 0).setBackground(default_color)
+        self.main.mem_table.highlight_pc(None)
         lc3_logic.run_instructions(self)
         self.main.mem_table.verticalScrollBar().setValue(registers.PC & bit_mask)  # If we step, make sure to follow
         self.emit_done()
 
     # Step through the code
     def step_app(self):
-        row = registers.PC & bit_mask
-        self.main.mem_table.item(row, 0).setBackground(default_color)
+        self.main.mem_table.highlight_pc(None)
         lc3_logic.step_instruction(self)
 
         if self.pc_out_of_view(self.main.mem_table, registers.PC & bit_mask):
@@ -356,18 +494,31 @@ class RunHandler(QtCore.QObject):
 
         self.emit_done()
 
+    # Undo the last instruction
+    def step_back_app(self):
+        self.main.mem_table.highlight_pc(None)
+        lc3_logic.step_back(self)
+
+        if self.pc_out_of_view(self.main.mem_table, registers.PC & bit_mask):
+            self.main.mem_table.verticalScrollBar().setValue(registers.PC & bit_mask)
+
+        self.emit_done()
+
+    # Run backwards to the previous breakpoint
+    def reverse_app(self):
+        self.main.mem_table.highlight_pc(None)
+        lc3_logic.reverse_continue(self)
+        self.main.mem_table.verticalScrollBar().setValue(registers.PC & bit_mask)
+        self.emit_done()
+
     @staticmethod
     def pc_out_of_view(mem_table, row):
         rect = mem_table.viewport().contentsRect()
-        top = mem_table.indexAt(rect.topLeft())
-        if top.isValid():
-            bottom = mem_table.indexAt(rect.bottomLeft())
-        if not bottom.isValid():
-            bottom = mem_table.model().index(mem_table.count() - 1)
-        for visible_row in range(top.row(), bottom.row()):
-            if visible_row == row:
-                return False
-        return True
+        top = mem_table.rowAt(rect.top())
+        bottom = mem_table.rowAt(rect.bottom())
+        if bottom < 0:
+            bottom = mem_table.model().rowCount()
+        return not top <= row < bottom
 
     # Slot for ending the current instruction run and closing the thread
     @QtCore.pyqtSlot()
@@ -419,7 +570,7 @@ class RegisterTable(QTableWidget):
                 if col % 3 == 1:
                     self.setItem(row, col, QTableWidgetItem(QString(to_hex_string(registers[reg_num]))))
                 if col % 3 == 2:
-                    self.setItem(row, col, QTableWidgetItem(QString(str(registers[reg_num]))))
+                    self.setItem(row, col, QTableWidgetItem(QString(str(sign_extend(registers[reg_num], 16)))))
 
         # Manually set the rest of the register info
         self.setItem(0, 6, QTableWidgetItem(QString('PC')))
@@ -465,22 +616,106 @@ class RegisterTable(QTableWidget):
                 reg_hex = to_hex_string(reg_val)
 
                 self.setItem(row, column - 1, QTableWidgetItem(QString(reg_hex)))
-                registers.registers[register] = reg_val  # Convert bit string at address to instruction
+                registers[register] = reg_val  # Convert bit string at address to instruction
             if column % 3 == 1:
                 register -= 1  # We must subtract 2 b/c the column + row combo will be off by 2 here
                 hex_string = str(self.item(row, column).text()[1:])
                 reg_val = int(hex_string, 16)
-                reg_hex = str(reg_val)
+                reg_hex = str(sign_extend(reg_val, 16))
 
                 self.setItem(row, column + 1, QTableWidgetItem(QString(reg_hex)))
-                registers.registers[register] = reg_val  # Convert bit string at address to instruction
+                registers[register] = reg_val  # Convert bit string at address to instruction
 
 
-# Class for the memory table GUI element
-class MemoryTable(QTableWidget):
+# Model behind the memory table: every cell is rendered from memory when the view asks for it,
+# so only the rows on screen cost anything
+# Columns: breakpoint/PC marker, address, binary, hex, label, disassembly
+class MemoryModel(QtCore.QAbstractTableModel):
     def __init__(self, *args):
-        QTableWidget.__init__(self, *args)
-        self.setData()
+        QtCore.QAbstractTableModel.__init__(self, *args)
+        self.labels = lc3_logic.machine.symbols
+        self.pc_row = None  # Row highlighted as the PC, None while running
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else 65536
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else 6
+
+    def data(self, index, role=Qt.DisplayRole):
+        row = index.row()
+        column = index.column()
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            if column == 1:
+                return QVariant(QString(to_hex_string(row)))
+            if column == 2:
+                return QVariant(QString(to_bin_string(memory[row])))
+            if column == 3:
+                return QVariant(QString(to_hex_string(memory[row])))
+            if column == 4:
+                return QVariant(QString(self.labels.get(row, '')))
+            if column == 5:
+                return QVariant(QString(parser.disassemble(row, memory[row], self.labels)))
+        elif role == Qt.BackgroundRole and column == 0:
+            if row == self.pc_row:
+                return QVariant(pc_color)
+            if row in memory.breakpoints:
+                return QVariant(breakpoint_color)
+            return QVariant(default_color)
+        elif role == Qt.ToolTipRole and column == 0 and row in memory.breakpoints:
+            tip = "Breakpoint, hit %d times" % memory.breakpoints.hits[row]
+            if memory.breakpoints.conditions[row] is not None:
+                tip += ", if " + memory.breakpoints.conditions[row].text
+            return QVariant(QString(tip))
+        return QVariant()
+
+    def flags(self, index):
+        if index.column() in (2, 3):  # Memory is edited as binary or hex
+            return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole:
+            return False
+        text = str(value.toString()).strip()
+        try:
+            if index.column() == 2:
+                inst = int(text, 2)
+            else:
+                inst = int(text[1:] if text[:1] in 'xX' else text, 16)
+        except ValueError:
+            return False
+        row = index.row()
+        memory[row] = inst & bit_mask
+        memory.mark_dirty(row)
+        self.update_rows([row])
+        return True
+
+    # Signal that rows changed, consecutive rows as one range
+    def update_rows(self, rows):
+        rows = sorted(set(rows))
+        if not rows:
+            return
+        first = last = rows[0]
+        for row in rows[1:]:
+            if row != last + 1:
+                self.dataChanged.emit(self.index(first, 0), self.index(last, 5))
+                first = row
+            last = row
+        self.dataChanged.emit(self.index(first, 0), self.index(last, 5))
+
+    # Move the PC highlight to row, None hides it
+    def highlight_pc(self, row):
+        old_row, self.pc_row = self.pc_row, row
+        self.update_rows([r for r in (old_row, row) if r is not None])
+
+
+# Class for the memory table GUI element, a view of a MemoryModel
+class MemoryTable(QtGui.QTableView):
+    def __init__(self, *args):
+        QtGui.QTableView.__init__(self, *args)
+        self.memory_model = MemoryModel(self)
+        self.setModel(self.memory_model)
         self.setColumnWidth(0, 40)
         self.setColumnWidth(1, 50)
         self.setColumnWidth(2, 163)
@@ -488,141 +723,46 @@ class MemoryTable(QTableWidget):
         self.setColumnWidth(4, 60)
         self.setColumnWidth(5, 140)
         self.verticalHeader().setVisible(False)
+        self.verticalHeader().setDefaultSectionSize(self.fontMetrics().height() + 6)
         header = self.horizontalHeader()
         header.setVisible(False)
         header.setResizeMode(2, QtGui.QHeaderView.Stretch)
         header.setResizeMode(4, QtGui.QHeaderView.Stretch)
         self.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
+        self.setEditTriggers(QtGui.QAbstractItemView.DoubleClicked)
         self.setMouseTracking(True)
-        self.edited_location = None
-        self.cellDoubleClicked.connect(self.set_edited_location)
-        self.itemChanged.connect(self.update_internal_memory)
         self.doubleClicked.connect(self.handle_double_click)
-        self.labels = None
-
-    # Same as register setData, although there might be a way to make this faster
-    def setData(self):
-        for row in range(self.rowCount()):
-            self.setItem(row, 0, QtGui.QTableWidgetItem())
-            self.item(row, 0).setFlags(QtCore.Qt.ItemIsSelectable)
-            if 0x514 <= row <= 0xFA00:
-                self.clearData(row)
-            else:
-                inst = memory.memory[row]
-                inst_bin = to_bin_string(inst)
-                inst_hex = to_hex_string(inst)
-
-                self.setItem(row, 1, QTableWidgetItem(QString(to_hex_string(row))))
-                self.item(row, 1).setFlags(QtCore.Qt.ItemIsEnabled)
-                self.setItem(row, 2, QTableWidgetItem(QString(inst_bin)))
-                self.setItem(row, 3, QTableWidgetItem(QString(inst_hex)))
-                self.set_info_column(row, inst)
-                self.item(row, 5).setFlags(QtCore.Qt.ItemIsEnabled)
-
-            self.item(row, 0).setBackground(default_color)
-            if row == registers.PC:
-                self.item(row, 0).setBackground(pc_color)
-            self.item(row, 0).setFlags(QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled)
 
     # Used when we know the range of the data to update, so that we don't have to update the entire table
-    def setDataRange(self, start, stop, labels={}):
-        self.labels = labels
-        for row in range(start, stop, 1):
-            inst = memory.memory[row]
-            inst_bin = to_bin_string(inst)
-            inst_hex = to_hex_string(inst)
-
-            self.setItem(row, 0, QtGui.QTableWidgetItem())
-            self.item(row, 0).setBackground(default_color)
-
-            if row == registers.PC:
-                self.item(row, 0).setBackground(pc_color)
-
-            self.setItem(row, 1, QTableWidgetItem(QString(to_hex_string(row))))
-            self.setItem(row, 2, QTableWidgetItem(QString(inst_bin)))
-            self.setItem(row, 3, QTableWidgetItem(QString(inst_hex)))
-            self.set_info_column(row, inst, labels)
-
-    def clearData(self, address):
-        self.item(address, 0).setFlags(QtCore.Qt.ItemIsSelectable)
-        self.setItem(address, 1, QTableWidgetItem(QString(to_hex_string(address))))
-        self.item(address, 1).setFlags(QtCore.Qt.ItemIsEnabled)
-        self.setItem(address, 2, QTableWidgetItem(QString("0" * 16)))
-        self.setItem(address, 3, QTableWidgetItem(QString("x0000")))
-        self.setItem(address, 4, QTableWidgetItem(QString("")))
-        self.setItem(address, 5, QTableWidgetItem(QString("NOP")))
-        self.item(address, 5).setFlags(QtCore.Qt.ItemIsEnabled)
-
-    def set_edited_location(self):
-        if self.selectedIndexes():
-            self.edited_location = self.selectedIndexes()[0]
+    def setDataRange(self, start, stop):
+        self.memory_model.update_rows(range(start, stop))
 
-    @QtCore.pyqtSlot(int)
-    def update_memory_table(self, changed):
-        if self.item(changed, 0) is not None:
-            self.setDataRange(changed, changed + 1)
+    # Redraw a batch of changed rows
+    def update_rows(self, rows):
+        self.memory_model.update_rows(rows)
 
-    def update_internal_memory(self):
-        if self.edited_location is not None:
-            address = self.edited_location.row()
-            column = self.edited_location.column()
-            self.edited_location = None
-            if address and column == 2:
-                bit_string = str(self.item(address, 2).text())
-                inst = int(bit_string, 2)
-                inst_hex = to_hex_string(inst)
-
-                self.setItem(address, 3, QTableWidgetItem(QString(inst_hex)))
-                self.set_info_column(address, inst)
-
-                memory[address] = inst  # Convert bit string at address to instruction
-            if address and column == 3:
-                hex_string = str(self.item(address, 3).text()[1:])
-                inst = int(hex_string, 16)
-                inst_bin = to_bin_string(inst)
-
-                self.setItem(address, 2, QTableWidgetItem(QString(inst_bin)))
-                self.set_info_column(address, inst)
-                memory[address] = inst  # Convert bit string at address to instruction
+    def highlight_pc(self, row):
+        self.memory_model.highlight_pc(row)
 
     def handle_double_click(self, cell):
         if cell.column() == 0:
             self.set_breakpoint(cell)
-        elif cell.column() == 5:
-            pass
 
     def set_breakpoint(self, cell):
-        if cell.row() & bit_mask not in memory.breakpoints:
-            self.item(cell.row(), cell.column()).setBackground(breakpoint_color)
-            memory.breakpoints.append(cell.row())
-        else:
-            memory.breakpoints.remove(cell.row() & bit_mask)
-            self.item(cell.row(), cell.column()).setBackground(default_color)
+        memory.breakpoints.toggle(cell.row())
+        self.update_rows([cell.row()])
         self.clearSelection()
 
-    def set_info_column(self, address, inst, labels=[]):
-        inst_list = parser.parse_any(inst)
-        if np.issubdtype(type(inst_list[-1]), int):
-            final_address = (inst_list[-1] + address & bit_mask) + 1
-            if final_address & bit_mask in labels:
-                final_address = labels[final_address & bit_mask]
-                inst_list[-1] = final_address
-            else:
-                inst_list[-1] = to_hex_string(final_address)
-        self.setItem(address, 5,
-                     QTableWidgetItem(QString(str(inst_list.pop(0)) + ' ' + ', '.join(str(e) for e in inst_list))))
-        self.item(address, 5).setFlags(QtCore.Qt.ItemIsEnabled)
 
 # Class for the file dialog
 class FileDialog(QtGui.QFileDialog):
     def __init__(self, *args):
         QtGui.QFileDialog.__init__(self, *args)
         self.main = None
-        self.labeled_addresses = {}
 
     def file_open(self, main):
         self.main = main
-        self.setNameFilters(["OBJ Files (*.obj)"])
+        self.setNameFilters(["OBJ Files (*.obj)", "Binary Text Files (*.txt)"])
         self.selectNameFilter("OBJ Files (*.obj)")
         file_names = self.getOpenFileNames(self, "Open files")
 
@@ -630,44 +770,25 @@ class FileDialog(QtGui.QFileDialog):
 
         if len(file_names) == 0:
             return
-        main.mem_table.item(registers.PC, 0).setBackground(default_color)
-        memory.key_queue = Queue(maxsize=100)  # Clear key buffer
-
-        # TODO: fix
-        for name in file_names:
-            self.check_symbol_table(name)
+        main.mem_table.highlight_pc(None)
+        memory.keyboard.clear()  # Clear key buffer
 
         for name in file_names:
-            interval = memory.load_instructions(name)
+            interval = lc3_logic.machine.load(str(name))  # Also reads its labels and forgets the undo history
             if interval[0] == default_origin:
                 found_default = True
             # Interval that we updated, used so that load times are faster
-            main.mem_table.setDataRange(interval[0], interval[1], self.labeled_addresses)
+            main.mem_table.setDataRange(interval[0], interval[1])
             main.mem_table.verticalScrollBar().setValue(interval[0])
             main.modified_data.append(interval)
 
         # In place so that the default_origin (probably 0x3000) is used instead of most recent
         # Only used if at least 1 file is found to start at default_origin
         if found_default:
-            main.mem_table.item(registers.PC, 0).setBackground(default_color)
             registers.set_origin(default_origin)
-            main.mem_table.item(registers.PC, 0).setBackground(pc_color)
             main.mem_table.verticalScrollBar().setValue(default_origin)
-
-    # TODO: fix this monstrosity (i.e. don't use 7 levels of statements)
-    def check_symbol_table(self, name):
-        base_name = name[:-4]
-        try:
-            with open(base_name + ".sym") as f:
-                for line in f:
-                    symbols = re.search('(?<=^...)(\w*).*([0-9a-fA-F]{4}).*$', line)  # Fancy regex for finding labels
-                    if symbols is not None:
-                        label = symbols.group(1)
-                        address = symbols.group(2)
-                        self.main.mem_table.setItem(int(address, 16), 4, QTableWidgetItem(QString(label)))
-                        self.labeled_addresses[int(address, 16)] = label
-        except IOError:
-            return  # It's fine, just no labels for them
+        main.mem_table.update_rows(memory.drain_dirty())  # Rows whose label was added or removed
+        main.mem_table.highlight_pc(registers.PC)
 
 
 # Class for the search bar
@@ -680,6 +801,8 @@ class SearchBar(QtGui.QWidget):
         self.enter_line = QtGui.QLineEdit()
         self.address_history = [default_origin]
         self.place = 0
+        self.matches = []  # Addresses found by the last search, see search.py
+        self.match = 0
 
         # TODO: implement this
         # self.history_popup = QtGui.QToolButton(self)
@@ -699,31 +822,75 @@ class SearchBar(QtGui.QWidget):
         self.prev_button.setMaximumSize(20, 40)
         self.prev_button.clicked.connect(self.prev_address)
 
+        self.enter_line.setToolTip('Address or label to go to, or a search: =x41 x42 (words), "text", LDI xFE00')
+        self.match_label = QtGui.QLabel(self)
+        self.prev_match_button = QtGui.QPushButton('Prev', self)
+        self.prev_match_button.setMaximumSize(40, 40)
+        self.prev_match_button.clicked.connect(lambda: self.show_match(self.match - 1))
+        self.next_match_button = QtGui.QPushButton('Next', self)
+        self.next_match_button.setMaximumSize(40, 40)
+        self.next_match_button.clicked.connect(lambda: self.show_match(self.match + 1))
+
         grid.addWidget(self.prev_button)
         grid.addWidget(self.next_button)
         grid.addWidget(self.enter_line)
+        grid.addWidget(self.match_label)
+        grid.addWidget(self.prev_match_button)
+        grid.addWidget(self.next_match_button)
         self.mem_table = mem_table
         self.enter_line.returnPressed.connect(self.show_line)
         self.setLayout(grid)
 
-    # Submit the search result and hop to that line
+    # Submit the search result and hop to that line, given as a label or a hex address
+    # Anything else that search.py understands finds every match, stepped through with Prev/Next
     def show_line(self):
-        line = str(self.enter_line.text())
-        if line[0] == 'x':
+        line = str(self.enter_line.text()).strip()
+        if not line:
+            return
+        row = lc3_logic.machine.symbols.address(line)
+        if row is None and search.is_query(line):
+            self.find(line)
+            return
+        if row is None and line[:1] in 'xX':
             line = line[1:]
         try:
-            row = int(line, 16)
-            self.mem_table.verticalScrollBar().setValue(row)
-            if len(self.address_history) <= self.place + 1:
-                self.address_history.append(row)
-            else:
-                self.address_history[self.place + 1] = row
-                self.address_history = self.address_history[0:self.place + 2]
-            self.place += 1
+            if row is None:
+                row = int(line, 16)
+            self.go_to(row)
         except ValueError:
             pass  # Invalid input, just clear it and move on
         self.enter_line.clear()
 
+    def go_to(self, row):
+        self.mem_table.verticalScrollBar().setValue(row)
+        if len(self.address_history) <= self.place + 1:
+            self.address_history.append(row)
+        else:
+            self.address_history[self.place + 1] = row
+            self.address_history = self.address_history[0:self.place + 2]
+        self.place += 1
+
+    def find(self, query):
+        try:
+            self.matches = search.search(memory.view(), query, lc3_logic.machine.symbols).tolist()
+        except ValueError as e:
+            self.match_label.setText(str(e))
+            return
+        if not self.matches:
+            self.match_label.setText("No matches")
+            return
+        self.show_match(0)
+
+    # Go to the match at index, wrapping around at both ends
+    def show_match(self, index):
+        if not self.matches:
+            return
+        self.match = index % len(self.matches)
+        row = self.matches[self.match]
+        self.match_label.setText("%d/%d" % (self.match + 1, len(self.matches)))
+        self.go_to(row)
+        self.mem_table.selectRow(row)
+
     def next_address(self):
         history = self.address_history
         place = self.place
@@ -757,6 +924,10 @@ class ButtonRow(QtGui.QWidget):
         self.step_over_button.setMaximumSize(70, 120)
         self.step_over_button.clicked.connect(lambda: window.run('over'))
 
+        self.step_back_button = QtGui.QPushButton('Step Back', self)
+        self.step_back_button.setMaximumSize(70, 120)
+        self.step_back_button.clicked.connect(lambda: window.run('back'))
+
         self.stop_button = QtGui.QPushButton('Stop', self)
         self.stop_button.setMaximumSize(70, 120)
         self.stop_button.clicked.connect(window.suspend_process)
@@ -776,6 +947,7 @@ class ButtonRow(QtGui.QWidget):
         self.grid.addWidget(self.run_button, 0, 0)
         self.grid.addWidget(self.step_button, 0, 1)
         self.grid.addWidget(self.step_over_button, 0, 2)
+        self.grid.addWidget(self.step_back_button, 0, 3)
         self.grid.addWidget(self.stop_button, 0, 4)
         self.grid.addWidget(self.pc_button, 0, 5)
         self.grid.addWidget(self.jump_button, 0, 6)
@@ -1,42 +1,45 @@
 import sys
 
-import time
-from PyQt4 import QtGui, QtCore
-from PyQt4.QtCore import Qt
-
-import alu
-import instruction_parser as parser
+from machine import Machine, KBSR, KBDR, DSR, DDR, TMR, TMC, MCR, NO_HISTORY, default_os_file
 from storage import *
-import lc3_gui
-import lc3_gui
-
-# Turn ON machine
-ON = True
-
-# Useful memory locations
-KBSR = -512  # 0xFE00
-KBDR = -510  # 0xFE02
-DSR = -508  # 0xFE04
-DDR = -506  # 0xFE06
-MCR = -2  # 0xFFFE
 
 bit_mask = 0xFFFF
 
-jump_ops = ['JSR', 'TRAP']
+# The machine driven by the GUI, built on the storage singletons
+machine = Machine(memory, registers)
+boot_snapshot = None  # Machine right after the OS was loaded, reinitializing restores it
+status = None  # Message for the GUI's status bar, shown and cleared when it updates its tables
 
-# Location of OS file
-# TODO: let the user submit their own OS file
-os_file_name = "LC3_OS.bin"
+# Location of OS file, a text file with one binary word per line
+os_file_name = default_os_file
 
 # Main function, initializes memory and starts running instructions
-def main():
-    memory.load_os()
+# The GUI keeps an undo history so it can step backwards, headless runs don't pay for it
+def main(os_file=None):
+    machine.record_history()
+    boot_os(os_file)
+    create_UI()
+
+
+# Load an OS, by default the last one, and take the snapshot that reinitializing restores
+# Returns the addresses it changed
+def boot_os(os_file=None):
+    global boot_snapshot, os_file_name
+    if os_file is not None:
+        os_file_name = os_file
+    machine.reset()
+    memory.load_os(os_file_name)
+    changed = memory.modified_data
     memory.reset_modified()
     memory[MCR] = 0x7FFF
-    create_UI()
+    boot_snapshot = machine.snapshot()
+    return changed
 
 
+# PyQt4 is only imported here, so the simulator can run headless without it
 def create_UI():
+    from PyQt4 import QtGui
+    import lc3_gui
     app = QtGui.QApplication(sys.argv)
     app.setStyle("Plastique")
     GUI = lc3_gui.Window()
@@ -49,261 +52,51 @@ def update_gui_registers(run_handler):
     run_handler.gui_updated.emit()
 
 
-# Handles basics for running instructions
-def run_instructions(run_handler):
-    while (memory[MCR] >> 15) & 0b1 == 1:
-        registers.PC += 1
-        inst = memory[registers.PC - 1]
-        registers.IR = inst
-        handle_IO(run_handler)
-        handle_instruction(inst, run_handler)
-        handle_IO(run_handler)
-        if not ON and registers.PC == sign_extend(0xFD79, 16):
-            memory[MCR] = 0x7FFF
-            break
-        if (registers.PC & 0xFFFF) in memory.breakpoints:
-            memory.breakpoints.remove((registers.PC & 0xFFFF))
-            break
-        if memory.paused:
-            break
-    memory.paused = False
+# Handles basics for running instructions, see Machine.run
+# Displayed characters go to output, by default the memory's output buffer that the GUI drains
+# Without a run_handler (headless), no signals are sent
+# Returns the number of instructions executed
+def run_instructions(run_handler=None, max_steps=None, output=None):
+    result = machine.run(max_steps, output=output)
+    if run_handler is not None:
+        finish_processing(run_handler)
+    return result.steps
+
+# Same as run instruction, but once (or over a whole subroutine when stepping over)
+def step_instruction(run_handler, output=None):
+    machine.step(memory.stepping_over, output)
+    finish_processing(run_handler)
+
+# Undo the last instruction, see Machine.step_back
+def step_back(run_handler):
+    report_undo(machine.step_back())
     finish_processing(run_handler)
 
-# Same as run instruction, but once
-def step_instruction(run_handler):
-    pre_inst = memory[registers.PC]
-    jumping = False
-    if memory.stepping_over and parser.parse_op(pre_inst >> 12) in jump_ops:
-        jumping = True
-    while True:
-        if memory[MCR] & 0x8000 != 0:
-            registers.PC += 1
-            inst = memory[registers.PC - 1]
-            registers.IR = inst
-            handle_IO(run_handler)
-            handle_instruction(inst, run_handler)
-            handle_IO(run_handler)
-            if not ON and registers.PC == sign_extend(0xFD79, 16):
-                memory[MCR] = 0x7FFF
-        if not jumping:
-            break
-        elif parser.parse_op(inst >> 12) == 'RET' and jumping:
-            break
-        elif not memory.stepping_over:
-            break
+# Undo instructions back to a breakpoint or a write watchpoint, see Machine.reverse_continue
+def reverse_continue(run_handler):
+    report_undo(machine.reverse_continue())
     finish_processing(run_handler)
 
+# Tell the user when the history ran out, it only goes back to the last load, reinitialize or
+# million or so records
+def report_undo(result):
+    global status
+    if result.reason == NO_HISTORY:
+        if result.steps:
+            status = "Undid %d instructions, the history ends here" % result.steps
+        else:
+            status = "Nothing to undo"
+
 def finish_processing(run_handler):
+    for address in (KBSR, KBDR, DDR, DSR, TMR, TMC):
+        memory.mark_dirty(address)
     run_handler.gui_updated.emit()
-    run_handler.memory_updated.emit(KBSR)
-    run_handler.memory_updated.emit(KBDR)
-    run_handler.memory_updated.emit(DDR)
-    run_handler.memory_updated.emit(DSR)
     run_handler.finished.emit()
 
 
-# Finds instruction and tells handle to execute it
+# Finds instruction and tells the machine to execute it
 def handle_instruction(inst, console):
-    opcode = inst >> 12
-    handlers[opcode](inst, console)
-
-# Handle the Display Data Register, called when updated
-def handle_DDR():
-    memory[DSR] = memory[DSR] & 0x7FFF
-
-# Handle the Keyboard Status Register, called when updated
-def handle_KBDR():
-    memory[KBSR] = memory[KBSR] & 0x7FFF
-
-# Handle checking the KBSR and the DDR
-# Including updating their memory and displaying characters on the console
-def handle_IO(run_handler):
-    if memory[KBSR] & 0x8000 == 0 and not memory.key_queue.empty():
-        memory[KBSR] = memory[KBSR] | 0x8000  # Reset KBSR
-        key = memory.key_queue.get()
-        if key == 0x0D:
-            key = 0x0A
-        memory[KBDR] = key  # Put key in KBDR
-
-    if memory[DSR] & 0x8000 == 0:
-        if memory[DDR] in range(256):
-            run_handler.ddr_updated.emit(chr(memory[DDR]))
-            memory[DSR] = memory[DSR] | 0x8000
-
-
-def handle_update_gui_memory(run_handler, changed):
-    run_handler.memory_updated.emit(changed)
-
-#
-# HANDLERS: THe following functions handle
-# their respective instructions
-#
-def handle_add(inst, console):
-    inst_list = parser.parse_add(inst)
-    # Check for imm
-    if inst_list[3] == 0:
-        V2 = registers[inst_list[4]]
-    else:
-        V2 = sign_extend(inst_list[4], 5)
-    DR = inst_list[1]
-    SR1 = registers[inst_list[2]]
-    # Let fsm execute add
-    inst_list_eval = [SR1, V2]
-    value = alu.execute_add(inst_list_eval)
-    registers.registers[DR] = value
-    registers.set_CC(value)
-
-
-def handle_not(inst, console):
-    inst_list = parser.parse_not(inst)
-    DR = inst_list[1]
-    SR = registers[inst_list[2]]
-    value = alu.execute_not(SR)
-    registers.registers[DR] = value
-    registers.set_CC(value)
-
-
-def handle_and(inst, console):
-    inst_list = parser.parse_add(inst)
-    # Check for imm
-    if inst_list[3] == 0:
-        V2 = registers[inst_list[4]]
-    else:
-        V2 = sign_extend(inst_list[4], 5)
-    DR = inst_list[1]
-    SR1 = registers[inst_list[2]]
-    # Let alu execute add
-    inst_list_eval = [SR1, V2]
-    value = alu.execute_and(inst_list_eval)
-    registers.registers[DR] = value
-    registers.set_CC(value)
-
-
-def handle_ld(inst, console):
-    inst_list = parser.parse_ld(inst)
-    DR = inst_list[1]
-    address = registers.PC + sign_extend(inst_list[2], 9)
-    value = memory[address]
-    registers.set_CC(value)
-    if address == KBDR:
-        handle_KBDR()
-    registers.registers[DR] = value
-
-
-def handle_ldi(inst, console):
-    inst_list = parser.parse_ldi(inst)
-    DR = inst_list[1]
-    address = registers.PC + sign_extend(inst_list[2], 9)
-    value = memory[memory[address]]
-    registers.set_CC(value)
-    if memory[address] == KBDR:
-        handle_KBDR()
-    registers.registers[DR] = value
-
-
-def handle_ldr(inst, console):
-    inst_list = parser.parse_ldr(inst)
-    DR = inst_list[1]
-    BaseR = inst_list[2]
-    address = registers.registers[BaseR] + sign_extend(inst_list[3], 6)
-    value = memory[address]
-    if address == KBDR:
-        handle_KBDR()
-    registers.registers[DR] = value
-    registers.set_CC(value)
-
-
-def handle_lea(inst, console):
-    inst_list = parser.parse_lea(inst)
-    DR = inst_list[1]
-    address = registers.PC + sign_extend(inst_list[2], 9)
-    registers.registers[DR] = address
-    value = address
-    registers.set_CC(value)
-
-def handle_st(inst, run_handler):
-    inst_list = parser.parse_st(inst)
-    SR = inst_list[1]
-    val = registers.registers[SR]
-    address = registers.PC + sign_extend(inst_list[2], 9)
-    memory[address] = val
-    if val == DDR:
-        handle_DDR()
-    changed = address
-    handle_update_gui_memory(run_handler, changed)
-
-
-def handle_sti(inst, console):
-    inst_list = parser.parse_st(inst)
-    SR = inst_list[1]
-    address = registers.PC + sign_extend(inst_list[2], 9)
-    sti_addr = memory[address]
-    val = registers.registers[SR]
-    memory[sti_addr] = val
-    if memory[address] == DDR:
-        handle_DDR()
-    changed = sti_addr & bit_mask
-    handle_update_gui_memory(console, changed)
-
-
-def handle_str(inst, console):
-    inst_list = parser.parse_str(inst)
-    SR = inst_list[1]
-    BaseR = inst_list[2]
-    address = registers.registers[BaseR] + sign_extend(inst_list[3], 6)
-    val = registers.registers[SR]
-    memory[address] = val
-    if registers.registers[SR] == DDR:
-        handle_DDR()
-    changed = address
-    handle_update_gui_memory(console, changed)
-
-
-def handle_br(inst, console):
-    inst_list = parser.parse_br(inst)
-    condition = '{:03b}'.format(inst_list[1])
-    cc = '{:03b}'.format(registers.CC)
-    address = registers.PC + sign_extend(inst_list[2], 9)
-    for i, bit in enumerate(condition):
-        if bit == "1" and bit == cc[i]:
-            registers.PC = address
-
-
-def handle_jsr(inst, console):
-    inst_list = parser.parse_jsr(inst)
-    if inst_list[1] == 1:  # JSR
-        address = registers.PC + sign_extend(inst_list[2], 11)
-    else:  # JSRR
-        BaseR = inst_list[2]
-        address = registers.registers[BaseR]
-    registers.registers[7] = registers.PC
-    registers.PC = address
-
-
-def handle_ret(inst, console):
-    inst_list = parser.parse_ret(inst)
-    BaseR = inst_list[1]
-    registers.PC = registers.registers[BaseR]
-
-
-def handle_rti(inst, console):
-    if registers.PSR >> 15 == 0:
-        registers.PC = memory[registers.registers[6]]
-        registers.registers[6] += 1
-        temp = memory[registers.registers[6]]
-        registers.registers[6] += 1
-        registers.PSR = temp
-        registers.CC = registers.PSR & 0b111
-    else:
-        print "Privilege mode exception."
-
-def handle_trap(inst, console):
-    global ON
-    registers.registers[7] = registers.PC
-    trap = parser.parse_trap(inst)[1]
-    registers.PC = memory[trap]
-    if trap == 0x25:
-        ON = False
+    machine.execute(inst)
 
 # Sign extend, used for SEXTing offsets
 def sign_extend(val, bits):
@@ -324,21 +117,3 @@ def to_bin_string(val):
 
 if __name__ == '__main__':
     main()
-
-# Must be defined below functions, just an array of possible instruction handlers
-handlers = [handle_br,
-            handle_add,
-            handle_ld,
-            handle_st,
-            handle_jsr,
-            handle_and,
-            handle_ldr,
-            handle_str,
-            handle_rti,
-            handle_not,
-            handle_ldi,
-            handle_sti,
-            handle_ret,
-            None,
-            handle_lea,
-            handle_trap]
\ No newline at end of file
@@ -0,0 +1,579 @@
+#
+# A complete LC3: memory, registers, devices and the run loop
+# Every Machine has its own state, so one process can simulate many of them
+#
+
+import os
+import time
+from collections import namedtuple
+
+import alu
+import devices
+import instruction_parser as parser
+import storage
+from debugger import WATCH_READ, WATCH_WRITE
+from devices import KBSR, KBDR, DSR, DDR, TMR, TMC, MCR, device_page
+from history import History, INSTRUCTION
+from interrupts import InterruptController
+from profiler import Profiler
+from symbols import SymbolTable
+from tracer import TraceWriter, opcode_flags, store_flags
+
+bit_mask = 0xFFFF
+default_origin = 0x3000
+halt_address = 0xFD79  # Where the OS HALT routine ends up, see Machine.interpret
+
+# Location of the bundled OS, independent of the working directory
+default_os_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "LC3_OS.bin")
+
+engines = ('interpreter', 'blocks')
+
+# Why a run stopped
+HALTED = 'halted'
+MAX_STEPS = 'max_steps'
+BREAKPOINT = 'breakpoint'
+WATCHPOINT = 'watchpoint'
+PAUSED = 'paused'
+UNTIL = 'until'
+STEPPED = 'stepped'
+NO_HISTORY = 'no_history'  # Reverse execution reached the oldest recorded instruction
+
+# Returned by Machine.run and Machine.step, pc is where execution stopped
+RunResult = namedtuple('RunResult', ['reason', 'steps', 'elapsed', 'pc'])
+
+# Machine state saved by Machine.snapshot, device registers are part of words
+# keys is the keyboard input still to be read (KeyboardInput.save)
+Snapshot = namedtuple('Snapshot', ['words', 'decoded', 'registers', 'PC', 'IR', 'CC', 'PSR', 'ON',
+                                   'keys', 'symbols', 'interrupts'])
+
+jump_ops = ['JSR', 'TRAP']
+
+
+class Machine(object):
+    # Uses the given memory and registers, or creates them with one of the storage backends
+    # engine is 'interpreter' (one instruction at a time) or 'blocks' (see block_engine)
+    # memory_file keeps memory in that file, so other processes can map it (see storage.MappedMemory)
+    def __init__(self, memory=None, registers=None, backend=storage.default_backend, engine='interpreter',
+                 memory_file=None):
+        if memory is None:
+            memory, registers = storage.create_state(backend, memory_file)
+        self.memory = memory
+        self.registers = registers
+        self.ON = True  # Cleared by the HALT trap
+        self.history = None  # Undo log, see record_history
+        self.trace = None  # Trace file writer, see record_trace
+        self.profiler = None  # See start_profile
+        self.symbols = SymbolTable()  # Labels of the loaded programs
+        self.output = memory.output.write  # Where displayed characters go, set by run and step
+        self.bus = devices.DeviceBus(memory)  # Loads and stores in the device page go through it
+        self.keyboard = devices.Keyboard(self)
+        self.keyboard.attach(self.bus)
+        self.display = devices.Display(self)
+        self.display.attach(self.bus)
+        self.timer = devices.Timer(self)
+        self.timer.attach(self.bus)
+        self.interrupts = InterruptController(self, [self.keyboard, self.timer])
+        self.engine = None
+        if engine == 'blocks':
+            import block_engine
+            self.engine = block_engine.BlockEngine(self)
+        # Just an array of possible instruction handlers, indexed by opcode
+        self.handlers = [self.handle_br,
+                         self.handle_add,
+                         self.handle_ld,
+                         self.handle_st,
+                         self.handle_jsr,
+                         self.handle_and,
+                         self.handle_ldr,
+                         self.handle_str,
+                         self.handle_rti,
+                         self.handle_not,
+                         self.handle_ldi,
+                         self.handle_sti,
+                         self.handle_ret,
+                         None,
+                         self.handle_lea,
+                         self.handle_trap]
+
+    # Power on: clear the registers, load the OS and the programs, and start the clock
+    def boot(self, programs=(), os_file=default_os_file):
+        self.reset()
+        self.memory.load_os(os_file)
+        self.memory.reset_modified()
+        self.load_programs(programs)
+
+    # Clear the registers, the keyboard and the display, memory is left alone
+    def reset(self):
+        registers = self.registers
+        for i in range(8):
+            registers[i] = 0
+        registers.IR = 0
+        registers.CC = 0b010
+        registers.PSR = 0x8000 + registers.CC
+        self.memory.keyboard.clear()
+        self.memory.output.clear()
+        self.memory.instructions_ran = 0
+        self.interrupts.reset()
+        self.ON = True
+
+    # Save the whole machine: memory, registers, PSR, device registers and queued keys
+    def snapshot(self):
+        registers = self.registers
+        words, decoded = self.memory.snapshot()
+        return Snapshot(words, decoded, [registers[i] for i in range(8)], registers.PC, registers.IR,
+                        registers.CC, registers.PSR, self.ON, self.memory.keyboard.save(), self.symbols.save(),
+                        self.interrupts.save())
+
+    # Put the machine back into a snapshot, it can be restored any number of times
+    # Returns the memory addresses that changed
+    def restore(self, snapshot):
+        registers = self.registers
+        changed = self.memory.restore(snapshot.words, snapshot.decoded)
+        for i, value in enumerate(snapshot.registers):
+            registers[i] = value
+        registers.PC = snapshot.PC
+        registers.IR = snapshot.IR
+        registers.CC = snapshot.CC
+        registers.PSR = snapshot.PSR
+        self.ON = snapshot.ON
+        self.memory.keyboard.restore(snapshot.keys)
+        self.interrupts.restore(snapshot.interrupts)
+        for address in self.symbols.restore(snapshot.symbols):  # Rows whose label changed need redrawing too
+            self.memory.mark_dirty(address)
+        if self.history is not None:
+            self.history.clear()
+        return changed
+
+    # Log every instruction from now on, so execution can be reversed (see history.py)
+    # While recording, runs use the interpreter even with the block engine
+    def record_history(self, capacity=None):
+        self.history = History() if capacity is None else History(capacity)
+
+    # Stream every instruction executed from now on to a trace file (see tracer.py), until stop_trace
+    # Like history, tracing runs use the interpreter
+    def record_trace(self, fname, compress=None):
+        self.stop_trace()
+        self.trace = TraceWriter(fname, compress)
+        return self.trace
+
+    # Close the trace file, returns the number of instructions traced
+    def stop_trace(self):
+        if self.trace is None:
+            return 0
+        trace, self.trace = self.trace, None
+        trace.close()
+        return len(trace)
+
+    # Count every instruction executed from now on by address, opcode and subroutine (see profiler.py)
+    # Like history, profiling runs use the interpreter
+    def start_profile(self):
+        self.profiler = Profiler(self.symbols)
+        return self.profiler
+
+    # Stop profiling, returns the profiler with the results
+    def stop_profile(self):
+        profiler, self.profiler = self.profiler, None
+        return profiler
+
+    # True if something looks at every instruction, which only the interpreter supports
+    def observed(self):
+        return self.history is not None or self.trace is not None or self.profiler is not None
+
+    # Load programs and start the clock
+    # Same as the GUI, the PC starts at the default origin if a program was loaded there
+    def load_programs(self, programs):
+        found_default = False
+        for name in programs:
+            if self.load(name)[0] == default_origin:
+                found_default = True
+        if found_default:
+            self.registers.set_origin(default_origin)
+        self.memory[MCR] = 0xFFFF
+
+    # Load an .obj file and point the PC at it, returns the interval of memory it filled
+    # Addresses whose label changed are marked dirty, the program's words are in the interval
+    def load(self, fname):
+        interval = self.memory.load_instructions(fname)
+        self.registers.set_origin(interval[0])
+        for address in self.symbols.load(fname, interval):
+            self.memory.mark_dirty(address)
+        if self.history is not None:
+            self.history.clear()
+        return interval
+
+    # Queue characters for the keyboard
+    def feed(self, text):
+        self.memory.keyboard.feed(text)
+
+    # Queue a file for the keyboard, it is read as the program asks for keys
+    def feed_file(self, fname):
+        self.memory.keyboard.feed_file(fname)
+
+    # Ask a running machine to stop, safe to call from another thread
+    def pause(self):
+        self.memory.paused = True
+
+    # Run until the machine halts, max_steps instructions are executed, a breakpoint or watchpoint
+    # is hit, pause() is called, or until is reached
+    # until is an address the PC reaches, or a function called with the machine after every instruction
+    # Displayed characters go to output, by default the memory's output buffer that the GUI drains
+    def run(self, max_steps=None, until=None, output=None):
+        self.output = self.memory.output.write if output is None else output
+        self.interrupts.update()
+        self.memory.watchpoints.last_hit = None
+        start = time.time()
+        if self.engine is None or self.observed():
+            steps, reason = self.interpret(max_steps, until)
+        else:
+            steps, reason = self.engine.run(max_steps, until)
+        self.memory.instructions_ran += steps
+        self.memory.paused = False
+        return RunResult(reason, steps, time.time() - start, self.registers.PC)
+
+    # Interpret with the history trimmed and the trace written out every capacity instructions,
+    # so neither can outgrow it
+    def interpret(self, max_steps, until):
+        history = self.history
+        trace = self.trace
+        if history is None and trace is None:
+            return self.interpret_steps(max_steps, until)
+        capacity = min(log.capacity for log in (history, trace) if log is not None)
+        steps = 0
+        while True:
+            count = capacity if max_steps is None else min(max_steps - steps, capacity)
+            ran, reason = self.interpret_steps(count, until)
+            steps += ran
+            if history is not None:
+                history.trim()
+            if trace is not None:
+                trace.records += ran
+                trace.flush()
+            if reason != MAX_STEPS or steps == max_steps:
+                return steps, reason
+
+    # The interpreter: fetch, decode and execute one instruction at a time
+    def interpret_steps(self, max_steps, until):
+        memory = self.memory
+        registers = self.registers
+        handlers = self.handlers
+        interrupts = self.interrupts
+        history = self.history
+        if history is not None:  # Its instruction records are appended here, see History.record
+            low = history.low.append
+            high = history.high.append
+            R = registers.registers
+        trace = self.trace
+        if trace is not None:  # So are its records, see TraceWriter.record
+            words = trace.words.append
+            R = registers.registers
+        profiler = self.profiler
+        breakpoints = memory.breakpoints
+        break_flags = breakpoints.flags
+        stop_at, until = split_until(until)
+        steps = 0
+        while memory[MCR] & 0x8000:
+            if steps == max_steps:
+                return steps, MAX_STEPS
+            steps += 1
+            pc = registers.PC
+            registers.PC = (pc + 1) & bit_mask
+            entry = memory.fetch(pc)
+            if history is not None:
+                register = entry[11]
+                low(pc | registers.PSR << 16)
+                high(R[register] | register << 16 | INSTRUCTION)
+            if profiler is not None:
+                profiler.record(pc, entry, registers, memory)
+            registers.IR = entry[-1]
+            handlers[entry[0]](entry)
+            if trace is not None:
+                register = entry[11]
+                flags = opcode_flags[entry[0]]
+                words(pc | entry[-1] << 16)
+                words(R[register] | flags | register << 16)
+                if flags == store_flags:
+                    words(registers.MAR | R[entry[1]] << 16)
+            if interrupts.armed:
+                interrupts.step()
+            if not self.ON and registers.PC == halt_address:
+                memory[MCR] = 0x7FFF
+                return steps, HALTED
+            if break_flags[registers.PC] and breakpoints.hit(registers.PC, registers, memory):
+                return steps, BREAKPOINT
+            if memory.paused:
+                return steps, self.pause_reason()
+            if registers.PC == stop_at or (until is not None and until(self)):
+                return steps, UNTIL
+        return steps, HALTED
+
+    # Execute the instruction at the PC, used by engines for what they don't handle themselves
+    def execute_next(self):
+        registers = self.registers
+        pc = registers.PC
+        registers.PC = (pc + 1) & bit_mask
+        entry = self.memory.fetch(pc)
+        if self.history is not None:
+            self.history.record(pc, entry, registers)
+        if self.profiler is not None:
+            self.profiler.record(pc, entry, registers, self.memory)
+        registers.IR = entry[-1]
+        self.handlers[entry[0]](entry)
+        if self.trace is not None:
+            self.trace.record(pc, entry, registers)
+        if self.interrupts.armed:
+            self.interrupts.step()
+        if not self.ON and registers.PC == halt_address:
+            self.memory[MCR] = 0x7FFF
+        return entry
+
+    # Execute one instruction, with over=True a JSR or TRAP runs until its RET
+    def step(self, over=False, output=None):
+        self.output = self.memory.output.write if output is None else output
+        self.interrupts.update()
+        start = time.time()
+        jumping = over and parser.parse_op(self.memory[self.registers.PC] >> 12) in jump_ops
+        steps = 0
+        while self.memory[MCR] & 0x8000:
+            entry = self.execute_next()
+            steps += 1
+            if not jumping or entry[0] == 0b1100:  # Stepping over ends at the RET
+                break
+        self.memory.instructions_ran += steps
+        self.memory.paused = False
+        if self.history is not None:
+            self.history.trim()
+        reason = STEPPED if self.memory[MCR] & 0x8000 else HALTED
+        return RunResult(reason, steps, time.time() - start, self.registers.PC)
+
+    # Undo up to count instructions, needs record_history
+    def step_back(self, count=1):
+        start = time.time()
+        steps = 0
+        reason = STEPPED
+        while steps < count:
+            if self.undo() is None:
+                reason = NO_HISTORY
+                break
+            steps += 1
+        return RunResult(reason, steps, time.time() - start, self.registers.PC)
+
+    # Undo instructions until the PC is at a breakpoint, an undone store hits a write watchpoint,
+    # or the history runs out
+    def reverse_continue(self, max_steps=None):
+        start = time.time()
+        break_flags = self.memory.breakpoints.flags
+        watch_flags = self.memory.watchpoints.flags
+        steps = 0
+        reason = MAX_STEPS
+        while steps != max_steps:
+            restored = self.undo()
+            if restored is None:
+                reason = NO_HISTORY
+                break
+            steps += 1
+            if break_flags[self.registers.PC]:
+                reason = BREAKPOINT
+                break
+            if any(watch_flags[address] & WATCH_WRITE for address in restored):
+                reason = WATCHPOINT
+                break
+        return RunResult(reason, steps, time.time() - start, self.registers.PC)
+
+    # Undo one instruction, returns the memory addresses it restored or None without history
+    def undo(self):
+        if self.history is None:
+            return None
+        restored = self.history.undo(self)
+        if restored is not None:
+            self.memory[MCR] = self.memory[MCR] | 0x8000  # Running again, even if it had halted
+        return restored
+
+    # Decode and execute an instruction word
+    def execute(self, inst):
+        entry = parser.decode(inst)
+        self.handlers[entry[0]](entry)
+
+    def pause_reason(self):
+        return WATCHPOINT if self.memory.watchpoints.last_hit is not None else PAUSED
+
+    # Report an access to a watched address, pausing execution if a watchpoint matches
+    def handle_watch(self, address, kind, old, new):
+        registers = self.registers
+        if self.memory.watchpoints.hit(address, kind, old, new, (registers.PC - 1) & bit_mask, registers, self.memory):
+            self.memory.paused = True
+
+    #
+    # HANDLERS: The following methods handle
+    # their respective instructions
+    # Each one takes a predecoded entry (see instruction_parser.decode)
+    #
+    def handle_add(self, inst):
+        registers = self.registers
+        # Check for imm
+        if inst[4] == 0:
+            V2 = registers[inst[3]]
+        else:
+            V2 = inst[5]
+        SR1 = registers[inst[2]]
+        value = alu.execute_add([SR1, V2])
+        registers[inst[1]] = value
+        registers.set_CC(value)
+
+    def handle_not(self, inst):
+        registers = self.registers
+        value = alu.execute_not(registers[inst[2]])
+        registers[inst[1]] = value
+        registers.set_CC(value)
+
+    def handle_and(self, inst):
+        registers = self.registers
+        # Check for imm
+        if inst[4] == 0:
+            V2 = registers[inst[3]]
+        else:
+            V2 = inst[5]
+        SR1 = registers[inst[2]]
+        value = alu.execute_and([SR1, V2])
+        registers[inst[1]] = value
+        registers.set_CC(value)
+
+    def handle_ld(self, inst):
+        memory = self.memory
+        registers = self.registers
+        address = (registers.PC + inst[7]) & bit_mask
+        value = self.bus.read(address) if address >= device_page else memory[address]
+        if memory.watchpoints.flags[address] & WATCH_READ:
+            self.handle_watch(address, WATCH_READ, value, value)
+        registers.set_CC(value)
+        registers[inst[1]] = value
+
+    def handle_ldi(self, inst):
+        memory = self.memory
+        registers = self.registers
+        pointer = (registers.PC + inst[7]) & bit_mask
+        address = self.bus.read(pointer) if pointer >= device_page else memory[pointer]
+        value = self.bus.read(address) if address >= device_page else memory[address]
+        if memory.watchpoints.flags[pointer] & WATCH_READ:
+            self.handle_watch(pointer, WATCH_READ, address, address)
+        if memory.watchpoints.flags[address] & WATCH_READ:
+            self.handle_watch(address, WATCH_READ, value, value)
+        registers.set_CC(value)
+        registers[inst[1]] = value
+
+    def handle_ldr(self, inst):
+        memory = self.memory
+        registers = self.registers
+        address = (registers[inst[2]] + inst[6]) & bit_mask
+        value = self.bus.read(address) if address >= device_page else memory[address]
+        if memory.watchpoints.flags[address] & WATCH_READ:
+            self.handle_watch(address, WATCH_READ, value, value)
+        registers[inst[1]] = value
+        registers.set_CC(value)
+
+    def handle_lea(self, inst):
+        registers = self.registers
+        address = (registers.PC + inst[7]) & bit_mask
+        registers[inst[1]] = address
+        registers.set_CC(address)
+
+    def handle_st(self, inst):
+        memory = self.memory
+        registers = self.registers
+        val = registers[inst[1]]
+        address = (registers.PC + inst[7]) & bit_mask
+        registers.MAR = address
+        if memory.watchpoints.flags[address] & WATCH_WRITE:
+            self.handle_watch(address, WATCH_WRITE, memory[address], val)
+        if self.history is not None:
+            self.history.record_word(address, memory[address])
+        if address >= device_page:
+            self.bus.write(address, val)
+        else:
+            memory[address] = val
+        memory.mark_dirty(address)
+
+    def handle_sti(self, inst):
+        memory = self.memory
+        registers = self.registers
+        pointer = (registers.PC + inst[7]) & bit_mask
+        sti_addr = self.bus.read(pointer) if pointer >= device_page else memory[pointer]
+        val = registers[inst[1]]
+        registers.MAR = sti_addr
+        if memory.watchpoints.flags[pointer] & WATCH_READ:
+            self.handle_watch(pointer, WATCH_READ, sti_addr, sti_addr)
+        if memory.watchpoints.flags[sti_addr] & WATCH_WRITE:
+            self.handle_watch(sti_addr, WATCH_WRITE, memory[sti_addr], val)
+        if self.history is not None:
+            self.history.record_word(sti_addr, memory[sti_addr])
+        if sti_addr >= device_page:
+            self.bus.write(sti_addr, val)
+        else:
+            memory[sti_addr] = val
+        memory.mark_dirty(sti_addr)
+
+    def handle_str(self, inst):
+        memory = self.memory
+        registers = self.registers
+        address = (registers[inst[2]] + inst[6]) & bit_mask
+        val = registers[inst[1]]
+        registers.MAR = address
+        if memory.watchpoints.flags[address] & WATCH_WRITE:
+            self.handle_watch(address, WATCH_WRITE, memory[address], val)
+        if self.history is not None:
+            self.history.record_word(address, memory[address])
+        if address >= device_page:
+            self.bus.write(address, val)
+        else:
+            memory[address] = val
+        memory.mark_dirty(address)
+
+    def handle_br(self, inst):
+        registers = self.registers
+        if inst[1] & registers.CC:  # Any of the requested n, z, p bits set in CC
+            registers.PC = (registers.PC + inst[7]) & bit_mask
+
+    def handle_jsr(self, inst):
+        registers = self.registers
+        if inst[10] == 1:  # JSR
+            address = (registers.PC + inst[8]) & bit_mask
+        else:  # JSRR
+            address = registers[inst[2]]
+        registers[7] = registers.PC
+        registers.PC = address
+
+    def handle_ret(self, inst):
+        self.registers.PC = self.registers[inst[2]]
+
+    def handle_rti(self, inst):
+        memory = self.memory
+        registers = self.registers
+        if registers.PSR >> 15 == 0:
+            registers.PC = memory[registers[6]]
+            registers[6] = registers[6] + 1
+            temp = memory[registers[6]]
+            registers[6] = registers[6] + 1
+            registers.PSR = temp
+            registers.CC = registers.PSR & 0b111
+            if temp & 0x8000:  # Back to user mode and its stack
+                interrupts = self.interrupts
+                interrupts.saved_ssp = registers[6]
+                registers[6] = interrupts.saved_usp
+        else:
+            print "Privilege mode exception."
+
+    def handle_trap(self, inst):
+        registers = self.registers
+        registers[7] = registers.PC
+        trap = inst[9]
+        registers.PC = self.memory[trap]
+        if trap == 0x25:
+            if self.history is not None and self.ON:
+                self.history.record_halt()
+            self.ON = False
+
+
+# Split until into an address to stop at and a function to call, either may be None
+def split_until(until):
+    if until is None or callable(until):
+        return None, until
+    return until & bit_mask, None
@@ -0,0 +1,167 @@
+#
+# Execution profiler: where a program spends its instructions
+#
+# Counts how often every address and every opcode executes, and follows JSR/JSRR/TRAP calls to
+# their RET (or RTI) to give each subroutine its call count and instruction counts:
+#   inclusive  instructions from its entry to its return, calls included (recursion counted once)
+#   exclusive  the same without the instructions of the subroutines it called
+# Subroutines are named from .sym labels (see symbols.SymbolTable), or after the trap they serve.
+#
+
+import json
+from array import array
+
+from symbols import SymbolTable
+from instruction_parser import parse_op
+
+nrow = 65536
+
+trap_names = {0x20: 'GETC', 0x21: 'OUT', 0x22: 'PUTS', 0x23: 'IN', 0x24: 'PUTSP', 0x25: 'HALT'}
+
+# Control flow kinds, indexed by opcode
+CALL = 1  # JSR, JSRR, TRAP
+JUMP = 2  # JMP, a RET when the base register is R7
+RETURN = 3  # RTI
+flow_kinds = [0] * 16
+flow_kinds[0b0100] = flow_kinds[0b1111] = CALL
+flow_kinds[0b1100] = JUMP
+flow_kinds[0b1000] = RETURN
+
+
+class Profiler(object):
+    # labels is the SymbolTable naming addresses, usually the machine's
+    def __init__(self, labels=None):
+        self.hits = array('L', [0]) * nrow  # Address -> times executed
+        self.opcodes = [0] * 16  # Opcode -> times executed
+        self.count = 0  # Instructions executed
+        self.labels = SymbolTable() if labels is None else labels
+        self.trap_labels = {}  # Trap routine address -> trap name
+        self.calls = {}  # Subroutine -> times called
+        self.inclusive = {}
+        self.exclusive = {}
+        self.edges = {}  # (caller, callee) -> times called
+        self.active = {}  # Subroutine -> frames of it on the stack, so recursion is only counted once
+        self.stack = []  # Frames: [subroutine, return address, count at entry, instructions in calls]
+
+    # Label of an address, or None
+    def label(self, address):
+        return self.labels.get(address) or self.trap_labels.get(address)
+
+    def name(self, address):
+        return self.label(address) or 'x%04X' % address
+
+    # Called before an instruction executes, pc is its address
+    def record(self, pc, entry, registers, memory):
+        if not self.stack:  # The first instruction run is the root
+            self.enter(pc, None)
+        self.hits[pc] += 1
+        opcode = entry[0]
+        self.opcodes[opcode] += 1
+        self.count += 1
+        kind = flow_kinds[opcode]
+        if kind == CALL:
+            if opcode == 0b1111:
+                target = memory[entry[9]]
+                if entry[9] in trap_names:
+                    self.trap_labels[target] = trap_names[entry[9]]
+            elif entry[10] == 1:  # JSR
+                target = (pc + 1 + entry[8]) & 0xFFFF
+            else:  # JSRR
+                target = registers.registers[entry[2]]
+            self.enter(target, (pc + 1) & 0xFFFF)
+        elif kind == JUMP and entry[2] == 7:
+            self.leave(registers.registers[7])
+        elif kind == RETURN:
+            self.leave(memory[registers.registers[6]])
+
+    # Counting starts with the next instruction, the call itself belongs to the caller
+    def enter(self, subroutine, return_address):
+        if self.stack:
+            caller = self.stack[-1][0]
+            self.edges[caller, subroutine] = self.edges.get((caller, subroutine), 0) + 1
+        self.calls[subroutine] = self.calls.get(subroutine, 0) + 1
+        self.active[subroutine] = self.active.get(subroutine, 0) + 1
+        self.stack.append([subroutine, return_address, self.count, 0])
+
+    # Returning to target closes the frame that was called from there, and any frames above it
+    # that never returned. A jump through R7 that no frame returns to is just a jump.
+    def leave(self, target):
+        for depth in range(len(self.stack) - 1, 0, -1):
+            if self.stack[depth][1] == target:
+                break
+        else:
+            return
+        while len(self.stack) > depth:
+            self.close(self.stack.pop(), self.count)
+
+    def close(self, frame, count):
+        subroutine, _, start, children = frame
+        elapsed = count - start
+        self.exclusive[subroutine] = self.exclusive.get(subroutine, 0) + elapsed - children
+        self.active[subroutine] -= 1
+        if self.active[subroutine] == 0:
+            self.inclusive[subroutine] = self.inclusive.get(subroutine, 0) + elapsed
+        if self.stack:
+            self.stack[-1][3] += elapsed
+
+    # Subroutine statistics, frames still on the stack counted up to now, most inclusive first
+    def subroutines(self):
+        inclusive = dict(self.inclusive)
+        exclusive = dict(self.exclusive)
+        inner = 0  # Instructions in the frame above, not yet added to its caller's
+        outermost = {}
+        for subroutine, _, start, called in reversed(self.stack):
+            elapsed = self.count - start
+            exclusive[subroutine] = exclusive.get(subroutine, 0) + elapsed - called - inner
+            inner = elapsed
+            outermost[subroutine] = start
+        for subroutine, start in outermost.items():
+            inclusive[subroutine] = inclusive.get(subroutine, 0) + self.count - start
+        return sorted(({'address': address, 'name': self.name(address), 'calls': self.calls[address],
+                        'inclusive': inclusive.get(address, 0), 'exclusive': exclusive.get(address, 0)}
+                       for address in self.calls), key=lambda s: (-s['inclusive'], s['address']))
+
+    # Most executed addresses, as (address, hits)
+    def hot_addresses(self, top=20):
+        counted = [(hits, address) for address, hits in enumerate(self.hits) if hits]
+        counted.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [(address, hits) for hits, address in counted[:top]]
+
+    def report(self, top=20):
+        return {'instructions': self.count,
+                'opcodes': dict((opcode_name(opcode), count) for opcode, count in enumerate(self.opcodes) if count),
+                'subroutines': self.subroutines(),
+                'calls': [{'caller': self.name(caller), 'callee': self.name(callee), 'calls': count}
+                          for (caller, callee), count in sorted(self.edges.items())],
+                'hot': [{'address': address, 'name': self.label(address), 'hits': hits}
+                        for address, hits in self.hot_addresses(top)]}
+
+    def report_json(self, top=20):
+        return json.dumps(self.report(top), indent=2, sort_keys=True)
+
+    def report_text(self, top=20):
+        report = self.report(top)
+        total = max(report['instructions'], 1)
+        lines = ['%d instructions' % report['instructions'], '', 'Opcodes:']
+        for name, count in sorted(report['opcodes'].items(), key=lambda item: -item[1]):
+            lines.append('  %-5s %10d %6.2f%%' % (name, count, 100.0 * count / total))
+        lines += ['', 'Subroutines:', '  %-31s %8s %12s %12s' % ('', 'calls', 'inclusive', 'exclusive')]
+        for s in report['subroutines']:
+            lines.append('  x%04X  %-24s %8d %12d %12d' % (s['address'], self.label(s['address']) or '',
+                                                          s['calls'], s['inclusive'], s['exclusive']))
+        lines += ['', 'Calls:']
+        for edge in report['calls']:
+            lines.append('  %s -> %s  %d' % (edge['caller'], edge['callee'], edge['calls']))
+        lines += ['', 'Hot addresses:']
+        for hot in report['hot']:
+            lines.append('  x%04X  %-24s %10d' % (hot['address'], hot['name'] or '', hot['hits']))
+        return '\n'.join(lines) + '\n'
+
+    # Write the report, as JSON if fname ends in .json
+    def write(self, fname, top=20):
+        with open(fname, 'w') as f:
+            f.write(self.report_json(top) if fname.endswith('.json') else self.report_text(top))
+
+
+def opcode_name(opcode):
+    return 'JMP' if opcode == 0b1100 else parse_op(opcode)
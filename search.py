@@ -0,0 +1,166 @@
+#
+# Memory search, every match found at once with NumPy over the memory array (Memory.view())
+#
+# Queries, as typed in the search bar:
+#   =x41 or =x41 x42 #67     words with these values, in a row
+#   "Hello\n"                a string, one character per word (PUTS) or packed two per word (PUTSP),
+#                            end it with \0 to only match null-terminated strings
+#   LDI xFE00                instructions: a mnemonic followed by any of its operands, e.g. ADD R1, R1, #-1,
+#   BRz LOOP, TRAP x25, RET  LD R0, JSR lc3_printf or HALT; targets are PC-relative addresses, for LDI/STI
+#                            also the address their pointer holds
+#   ?ADD                     an instruction that could also be read as a hex address (x0ADD)
+# Numbers are written x41, #65 or 65, targets can also be labels.
+#
+
+import re
+
+import numpy as np
+
+from debugger import parse_address
+
+opcodes = {'BR': 0b0000, 'ADD': 0b0001, 'LD': 0b0010, 'ST': 0b0011, 'JSR': 0b0100, 'JSRR': 0b0100,
+           'AND': 0b0101, 'LDR': 0b0110, 'STR': 0b0111, 'RTI': 0b1000, 'NOT': 0b1001, 'LDI': 0b1010,
+           'STI': 0b1011, 'JMP': 0b1100, 'RET': 0b1100, 'LEA': 0b1110, 'TRAP': 0b1111}
+trap_aliases = {'GETC': 0x20, 'OUT': 0x21, 'PUTS': 0x22, 'IN': 0x23, 'PUTSP': 0x24, 'HALT': 0x25}
+
+# Register fields an instruction's register operands are written in, as bit shifts
+register_fields = {'ADD': (9, 6, 0), 'AND': (9, 6, 0), 'NOT': (9, 6), 'LD': (9,), 'LDI': (9,), 'LEA': (9,),
+                   'ST': (9,), 'STI': (9,), 'LDR': (9, 6), 'STR': (9, 6), 'JMP': (6,), 'JSRR': (6,)}
+
+branch = re.compile(r'^BR(N?Z?P?)$')
+operand_split = re.compile(r'[\s,]+')
+hex_address = re.compile(r'^[xX]?[0-9a-fA-F]+$')  # What the search bar jumps to
+
+
+def sign_extend(values, bits):
+    sign_bit = 1 << (bits - 1)
+    return (values ^ sign_bit) - sign_bit
+
+
+# Addresses where sequence starts, masks (if given) select the bits of each word that must match
+def find_sequence(words, sequence, masks=None):
+    if masks is None:
+        masks = [0xFFFF] * len(sequence)
+    count = len(words) - len(sequence) + 1
+    if not sequence or count <= 0:
+        return np.zeros(0, dtype=np.int64)
+    matches = np.flatnonzero(words[:count] & masks[0] == sequence[0])
+    for offset in range(1, len(sequence)):
+        if not len(matches):
+            break
+        matches = matches[words[matches + offset] & masks[offset] == sequence[offset]]
+    return matches
+
+
+# Addresses of text stored one character per word or packed two per word, low byte first
+def find_string(words, text):
+    unpacked = find_sequence(words, [ord(char) for char in text])
+    pairs = [text[i:i + 2] for i in range(0, len(text), 2)]
+    packed = [ord(pair[0]) | (ord(pair[1]) << 8 if len(pair) == 2 else 0) for pair in pairs]
+    masks = [0xFFFF if len(pair) == 2 else 0x00FF for pair in pairs]
+    return np.union1d(unpacked, find_sequence(words, packed, masks))
+
+
+# Addresses of the instructions matching a mnemonic and its operands
+# labels maps names to addresses, e.g. a symbols.SymbolTable
+def find_instructions(words, mnemonic, operands=(), labels=None):
+    mnemonic = mnemonic.upper()
+    words = np.asarray(words).astype(np.int32)
+    if mnemonic in trap_aliases:
+        mnemonic, operands = 'TRAP', ['x%02X' % trap_aliases[mnemonic]]
+    match = branch.match(mnemonic)
+    if match is not None:
+        flags, mnemonic = match.group(1), 'BR'
+    elif mnemonic not in opcodes:
+        raise ValueError("Unknown instruction: " + mnemonic)
+    addresses = np.flatnonzero(words >> 12 == opcodes[mnemonic])
+    found = words[addresses]
+
+    def keep(condition):
+        return addresses[condition], found[condition]
+
+    if mnemonic == 'BR':
+        if flags:  # Exactly these condition codes
+            nzp = ('N' in flags) << 2 | ('Z' in flags) << 1 | ('P' in flags)
+            addresses, found = keep((found >> 9) & 0b111 == nzp)
+        else:  # Any branch, not the NOPs
+            addresses, found = keep((found >> 9) & 0b111 != 0)
+    elif mnemonic in ('JSR', 'JSRR'):
+        addresses, found = keep((found >> 11) & 1 == (mnemonic == 'JSR'))
+    elif mnemonic == 'RET':
+        addresses, found = keep((found >> 6) & 0b111 == 7)
+
+    registers = [operand for operand in operands if re.match(r'^[rR][0-7]$', operand)]
+    numbers = [operand for operand in operands if operand not in registers]
+    fields = register_fields.get(mnemonic, ())
+    if len(registers) > len(fields) or len(numbers) > 1:
+        raise ValueError("Too many operands for " + mnemonic)
+    for shift, register in zip(fields, registers):
+        condition = (found >> shift) & 0b111 == int(register[1])
+        if shift == 0:  # ADD/AND third operand, only in register mode
+            condition &= (found >> 5) & 1 == 0
+        addresses, found = keep(condition)
+    if numbers:
+        number = parse_number(numbers[0], labels)
+        if mnemonic in ('ADD', 'AND'):
+            condition = ((found >> 5) & 1 == 1) & (sign_extend(found & 0b11111, 5) == sign_extend(number & 0b11111, 5))
+        elif mnemonic in ('LDR', 'STR'):
+            condition = sign_extend(found & 0b111111, 6) & 0xFFFF == number & 0xFFFF
+        elif mnemonic == 'TRAP':
+            condition = found & 0xFF == number
+        elif mnemonic == 'JSR':
+            condition = (addresses + 1 + sign_extend(found & 0x7FF, 11)) & 0xFFFF == number & 0xFFFF
+        elif mnemonic in ('BR', 'LD', 'LDI', 'LEA', 'ST', 'STI'):
+            targets = (addresses + 1 + sign_extend(found & 0x1FF, 9)) & 0xFFFF
+            condition = targets == number & 0xFFFF
+            if mnemonic in ('LDI', 'STI'):
+                condition |= np.asarray(words)[targets] == number & 0xFFFF
+        else:
+            raise ValueError(mnemonic + " takes no number")
+        addresses, found = keep(condition)
+    return addresses
+
+
+def parse_number(text, labels=None):
+    if labels is not None:
+        address = labels.address(text) if hasattr(labels, 'address') else labels.get(text)
+        if address is not None:
+            return address
+    try:
+        return parse_address(text)
+    except ValueError:
+        raise ValueError("Not a number or label: " + text)
+
+
+# Run a query (see the top of this file), returns the sorted addresses of every match
+def search(words, query, labels=None):
+    query = query.strip()
+    if not query:
+        raise ValueError("Empty search")
+    if query[0] == '=':
+        values = [parse_number(value, labels) & 0xFFFF for value in operand_split.split(query[1:].strip()) if value]
+        if not values:
+            raise ValueError("Nothing to search for")
+        return find_sequence(words, values)
+    if query[0] == '"':
+        if len(query) < 3 or query[-1] != '"':
+            raise ValueError("Strings are written in double quotes")
+        return find_string(words, query[1:-1].decode('string_escape'))
+    if query[0] == '?':
+        query = query[1:]
+    parts = [part for part in operand_split.split(query) if part]
+    if not parts:
+        raise ValueError("Nothing to search for")
+    return find_instructions(words, parts[0], parts[1:], labels)
+
+
+# True if text looks like a search rather than an address or label to jump to
+# Hex addresses come first, so ADD goes to x0ADD and ?ADD searches for ADDs
+def is_query(text):
+    text = text.strip()
+    if text[:1] in ('=', '"', '?'):
+        return True
+    if hex_address.match(text):
+        return False
+    mnemonic = re.split(r'[\s,]', text, 1)[0].upper()
+    return mnemonic in opcodes or mnemonic in trap_aliases or branch.match(mnemonic) is not None
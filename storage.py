@@ -1,8 +1,29 @@
 import numpy as np
-import binascii as ba
-from Queue import *
+import hashlib
+import mmap
+import os
+import tempfile
+from array import array
+from collections import deque
+from itertools import izip
+
+import instruction_parser as parser
+from debugger import Breakpoints, Watchpoints
+from keyboard import KeyboardInput
 
 nrow = 65536
+bit_mask = 0xFFFF
+output_capacity = 1 << 20  # Characters of console output kept before the oldest are dropped
+
+# Compiled OS images, see os_image
+os_cache_dir = os.environ.get('LC3_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'lc3'))
+
+# All values are stored unsigned, 0x0000 - 0xFFFF, and masked to 16 bits when written.
+# Two backends hold them:
+#   'int'   - array('H') memory and a list of registers, read as plain Python ints (fast)
+#   'numpy' - uint16 NumPy arrays, convenient for bulk operations
+#   'mmap'  - a NumPy array over a memory mapping, see MappedMemory
+# view() gives a NumPy array over either memory backend without copying it.
 
 
 # Register class for registers, PC, IR, and CC
@@ -13,31 +34,31 @@ class Registers(object):
         self.IR = IR
         self.CC = CC
         self.PSR = 0x8000 + self.CC
+        self.MAR = 0  # Address of the last store the interpreter executed, for traces
 
     def __getitem__(self, position):
-        return self.registers[position]
+        return self.registers.item(position)
 
     def __setitem__(self, position, item):
-        self.registers[position] = item
+        self.registers[position] = item & bit_mask
 
     # Handles .ORIG line
     def set_origin(self, origin):
         self.PC = origin
 
     def set_CC(self, value):
-        if value < 0:
+        value &= bit_mask
+        if value & 0x8000:
             self.CC = 0b100
         elif value == 0:
             self.CC = 0b010
-        elif value > 0:
-            self.CC = 0b001
         else:
-            print "Invalid CC state entered."
+            self.CC = 0b001
         self.PSR = (self.PSR & 0xFFF8) + self.CC
 
     def print_registers(self):
-        for i, register in enumerate(self.registers):
-            print "R" + str(i) + ": " + to_hex_string(register)
+        for i in range(len(self.registers)):
+            print "R" + str(i) + ": " + to_hex_string(self[i])
 
     def print_spec_regs(self):
         print "PC: " + to_hex_string(self.PC)
@@ -46,67 +67,283 @@ class Registers(object):
         print "CC: " + '{:03b}'.format(self.CC)
 
 
-# Memory class: 0xFFFF memory locations, containing a singed 16 bit number
+# Registers held as plain ints, for the 'int' backend
+class IntRegisters(Registers):
+    def __getitem__(self, position):
+        return self.registers[position]
+
+
+# Memory class: 0xFFFF memory locations, containing an unsigned 16 bit number
 class Memory(object):
-    def __init__(self, mem=np.empty(nrow, dtype='int16')):
+    def __init__(self, mem=None):
+        if mem is None:
+            mem = np.zeros(nrow, dtype='uint16')
         self.memory = mem
         self.paused = False
         self.modified_data = []
-        self.breakpoints = []
-        self.instructions_ran = 0
-        self.key_queue = Queue(maxsize=100)
+        self.breakpoints = Breakpoints()
+        self.watchpoints = Watchpoints()
+        self.instructions_ran = 0  # Counted by Machine.run and Machine.step
+        self.keyboard = KeyboardInput()
+        self.output = OutputBuffer()
         self.stepping_over = False
+        self.decoded = [None] * nrow  # Predecoded instruction for every address, None if stale
+        self.translated = bytearray(nrow)  # Addresses covered by a compiled block (see block_engine)
+        self.engine = None
+        self.dirty = bytearray(nrow)  # Addresses changed since the GUI last drew them
+        self.dirty_queue = deque()
 
     def __getitem__(self, position):
-        return self.memory[position]
+        return self.memory.item(position)
 
     def __setitem__(self, position, item):
-        self.memory[position] = item
+        self.memory[position] = item & bit_mask
+        self.decoded[position] = None  # Word changed, decode it again when it is fetched
+        if self.translated[position]:
+            self.engine.invalidate(int(position) & 0xFFFF)
+
+    # Returns the predecoded instruction at position, decoding it if it was overwritten
+    def fetch(self, position):
+        entry = self.decoded[position]
+        if entry is None:
+            entry = self.decoded[position] = parser.decode(self[position])
+        return entry
+
+    # Record a changed address, the GUI drains them at its own refresh rate
+    # Lock free: deque appends/pops are atomic and the flags keep each address queued once
+    def mark_dirty(self, position):
+        if not self.dirty[position]:
+            self.dirty[position] = 1
+            self.dirty_queue.append(position)
 
+    # Returns every address changed since the last call
+    def drain_dirty(self):
+        changed = []
+        queue = self.dirty_queue
+        while queue:
+            position = queue.popleft()
+            self.dirty[position] = 0
+            changed.append(position)
+        return changed
+
+    # NumPy array sharing this memory's storage
+    def view(self):
+        return self.memory
+
+    # Fast callable returning the plain int stored at an address
+    def reader(self):
+        return self.memory.item
+
+    # Copy of every word and its decoded entry, taken in one buffer copy
+    def snapshot(self):
+        return self.view().copy(), list(self.decoded)
+
+    # Put back a snapshot, marking the addresses that change dirty for the GUI
+    # Returns the changed addresses
+    def restore(self, words, decoded):
+        view = self.view()
+        changed = np.flatnonzero(view != words)
+        view[changed] = words[changed]  # Only touch what changed, untouched mapped pages stay shared
+        self.decoded[:] = decoded
+        changed_list = changed.tolist()
+        if self.engine is not None:
+            self.engine.invalidate_words(changed_list)
+        for position in changed_list:
+            self.mark_dirty(position)
+        return changed
+
+    # Decode all of memory in one go
+    def predecode(self, start=0, stop=nrow):
+        self.decoded[start:stop] = parser.decode_table(self.view()[start:stop])
+        if self.engine is not None:
+            self.engine.invalidate_range(start, stop)
+
+    # Copy a program into memory in one slice, words past the end of memory are dropped
     def load_instructions(self, fname):
-        inst_list = parse_obj(fname)
-        orig = int(inst_list.pop(0), 2)
-        total = 0
-        for i, inst in enumerate(inst_list):
-            self.memory[sign_extend(orig, 16) + i] = int(inst, 2)
-            total += 1
-        registers.set_origin(orig)
-        return orig, orig + total  # Return interval that was modified
-
-    # Loads LC3 Operating System from text file
-    def load_os(self):
-        self.breakpoints = []
-        fname = "LC3_OS.bin"
-        with open(fname) as f:
-            for irow, line in enumerate(f):
-                inst = int(line, 2)
-                if self.memory[irow] & 0xFFFF != inst:
-                    self.modified_data.append(irow)
-                    self[irow] = inst
+        words = read_obj(fname)
+        if not len(words):
+            raise ValueError("Empty object file: " + str(fname))
+        orig = int(words[0])
+        stop = min(orig + len(words) - 1, nrow)
+        self.view()[orig:stop] = words[1:1 + stop - orig]
+        self.predecode(orig, stop)
+        return orig, stop  # Return interval that was modified
+
+    # Loads LC3 Operating System from text file, only the words that differ are written and decoded
+    def load_os(self, fname="LC3_OS.bin"):
+        self.breakpoints.clear()
+        image = os_image(fname)
+        view = self.view()
+        changed = np.flatnonzero(view != image)
+        view[changed] = image[changed]
+        self.words_changed(changed)
+
+    # Decode the words at the changed addresses again and record them in modified_data
+    def words_changed(self, changed):
+        if not len(changed):
+            return
+        decoded = self.decoded
+        changed_list = changed.tolist()
+        for position, entry in izip(changed_list, parser.decode_table(self.view()[changed])):
+            decoded[position] = entry
+        self.modified_data.extend(changed_list)
+        if self.engine is not None:
+            self.engine.invalidate_words(changed_list)
 
     def reset_modified(self):
         self.modified_data = []
 
 
-# Parse .obj files
-def parse_obj(fname):
-    chars = []
-    with open(fname, "rb") as f:
-        for line in f:
-            for char in line:
-                chars.append('{:08b}'.format(int(ba.hexlify(char), 16)))
-    combined_chars = []
-    j = 0
-    while j + 1 < len(chars):
-        char1 = chars[j]
-        char2 = chars[j + 1]
-        combined_chars.append(char1 + char2)
-        j += 2
-    return combined_chars
-
-# Create an instance (singleton) of the memory and the registers
-memory = Memory()
-registers = Registers(np.array([0, 0, 0, 0, 0, 0, 0, 0], dtype='int16'), 0, 0, 0)
+# Ring buffer between the simulated display and the console
+# The simulation writes characters, the GUI drains them in chunks at its own pace
+class OutputBuffer(object):
+    def __init__(self, capacity=output_capacity):
+        self.chars = deque(maxlen=capacity)
+        self.write = self.chars.append
+
+    # Returns everything written since the last call as one string
+    def drain(self):
+        pop = self.chars.popleft
+        return ''.join([pop() for _ in range(len(self.chars))])
+
+    def clear(self):
+        self.chars.clear()
+
+
+# Memory held in an array('H'), for the 'int' backend
+class IntMemory(Memory):
+    def __init__(self):
+        Memory.__init__(self, array('H', [0]) * nrow)
+
+    def __getitem__(self, position):
+        return self.memory[position]
+
+    def view(self):
+        return np.frombuffer(self.memory, dtype=np.uint16)
+
+    def reader(self):
+        return self.memory.__getitem__
+
+
+# Memory in a memory mapping, for the 'mmap' backend
+# Private by default: loading an OS maps its cached image copy-on-write, so every machine booting
+# that OS (e.g. in forked grader workers) shares its pages, and only pages a program writes get copied.
+# With shared=True memory is the file fname itself, so other processes can map it to watch a live machine.
+class MappedMemory(Memory):
+    def __init__(self, fname=None, shared=False):
+        self.shared = shared
+        if fname is None:
+            mapping = mmap.mmap(-1, nrow * 2, access=mmap.ACCESS_COPY)
+        else:
+            if shared and (not os.path.exists(fname) or os.path.getsize(fname) < nrow * 2):
+                with open(fname, 'ab') as f:
+                    f.truncate(nrow * 2)
+            mapping = map_file(fname, shared)
+        self.mapping = mapping
+        Memory.__init__(self, np.frombuffer(mapping, dtype='<u2'))
+
+    def load_os(self, fname="LC3_OS.bin"):
+        image_file = os_image_file(fname)
+        if self.shared or image_file is None:  # Copy the image in
+            return Memory.load_os(self, fname)
+        # Swap in a fresh copy-on-write mapping of the image, then catch up with what changed
+        self.breakpoints.clear()
+        mapping = map_file(image_file, False)
+        image = np.frombuffer(mapping, dtype='<u2')
+        changed = np.flatnonzero(self.memory != image)
+        self.mapping = mapping
+        self.memory = image
+        self.words_changed(changed)
+
+
+def map_file(fname, shared):
+    with open(fname, 'r+b' if shared else 'rb') as f:
+        return mmap.mmap(f.fileno(), nrow * 2, access=mmap.ACCESS_WRITE if shared else mmap.ACCESS_COPY)
+
+
+backends = {'int': (IntMemory, IntRegisters, list),
+            'numpy': (Memory, Registers, lambda values: np.array(values, dtype='uint16')),
+            'mmap': (MappedMemory, IntRegisters, list)}
+default_backend = 'int'
+
+
+# Create a memory and registers pair using one of the backends above
+# memory_file gives a shared MappedMemory over that file, whatever the backend
+def create_state(backend=default_backend, memory_file=None):
+    memory_class, registers_class, register_file = backends[backend]
+    if memory_file is not None:
+        memory_class, registers_class, register_file = backends['mmap']
+        memory = MappedMemory(memory_file, shared=True)
+    else:
+        memory = memory_class()
+    return memory, registers_class(register_file([0, 0, 0, 0, 0, 0, 0, 0]), 0, 0, 0)
+
+
+# The OS as an array of every memory word, from a text file with one binary word per line
+# It is compiled once into a little-endian binary image in os_cache_dir, keyed by the text's hash
+def os_image(fname):
+    cache_file = os_image_file(fname)
+    if cache_file is not None:
+        try:
+            return np.fromfile(cache_file, dtype='<u2')
+        except (IOError, OSError):
+            pass  # Compile it here instead
+    with open(fname, 'rb') as f:
+        return compile_os(f.read())
+
+
+# Path of the compiled image of an OS text file, compiling it if needed
+# Returns None if no readable image can be written, e.g. on a read-only home directory
+# Images are readable by everyone the umask allows, so a shared cache directory works
+def os_image_file(fname):
+    with open(fname, 'rb') as f:
+        source = f.read()
+    cache_file = os.path.join(os_cache_dir, '%s-%s.img' % (os.path.basename(fname), hashlib.md5(source).hexdigest()))
+    if os.path.exists(cache_file) and os.path.getsize(cache_file) == nrow * 2 and os.access(cache_file, os.R_OK):
+        return cache_file
+    try:  # Write and rename, so processes booting at the same time never read half an image
+        if not os.path.isdir(os_cache_dir):
+            os.makedirs(os_cache_dir)
+        fd, temp_file = tempfile.mkstemp(dir=os_cache_dir)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0644 & ~umask)  # mkstemp leaves it readable by its owner only
+        with os.fdopen(fd, 'wb') as f:
+            compile_os(source).tofile(f)
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError):
+        return None
+    return cache_file
+
+
+def compile_os(source):
+    words = parse_binary_text(source)
+    image = np.zeros(nrow, dtype='<u2')
+    image[:len(words)] = words
+    return image
+
+
+# Words of an object file, starting with the origin
+# Accepts .obj files (big-endian 16 bit words) and text files with one binary word per line
+def read_obj(fname):
+    with open(fname, 'rb') as f:
+        data = f.read()
+    if data and not data.translate(None, '01 \t\r\n'):
+        return parse_binary_text(data)
+    return np.frombuffer(data, dtype='>u2', count=len(data) // 2)
+
+
+# Text with one 16 digit binary word per line, as in LC3_OS.bin and instructions/Quiz/quiz.txt
+def parse_binary_text(data):
+    lines = data.split()
+    digits = np.frombuffer(''.join(lines), dtype='uint8')
+    if len(digits) != 16 * len(lines):
+        raise ValueError("Every line needs 16 binary digits")
+    return (digits.reshape(-1, 16) - ord('0')).dot(1 << np.arange(15, -1, -1)).astype('uint16')
+
+# Create an instance (singleton) of the memory and the registers, used by the GUI
+# Other clients create their own with machine.Machine
+memory, registers = create_state()
 
 # Used for properly formatting/printing hex numbers
 def to_hex_string(val):
@@ -0,0 +1,121 @@
+#
+# Symbol tables written by the LC3 assembler/compiler next to each .obj, e.g.
+#   //	lc3_countForwardTo  3091
+#
+# .sym files are parsed once per modification time, and a SymbolTable keeps the labels of every
+# loaded program apart, so loading a program again or over another one replaces only its labels.
+#
+
+import os
+import re
+from collections import OrderedDict
+
+symbol_line = re.compile(r'^//\s+(\w+)\s+([0-9a-fA-F]{4})\s*$', re.MULTILINE)
+
+# .sym file -> (mtime, {address: label})
+parsed = {}
+
+
+# The .sym file belonging to an object file
+def sym_file(obj_name):
+    return os.path.splitext(obj_name)[0] + '.sym'
+
+
+# Returns {address: label} from a .sym file, empty if there is none
+# The result is shared between callers, don't change it
+def read_sym(fname):
+    try:
+        mtime = os.stat(fname).st_mtime
+    except OSError:
+        return {}  # It's fine, just no labels
+    cached = parsed.get(fname)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(fname) as f:
+        labels = dict((int(address, 16), label) for label, address in symbol_line.findall(f.read()))
+    parsed[fname] = (mtime, labels)
+    return labels
+
+
+# The labels of the loaded programs, looked up by address or by name
+# Can be used as a read-only {address: label} dict, e.g. by instruction_parser.disassemble
+class SymbolTable(object):
+    def __init__(self):
+        self.files = OrderedDict()  # Object file -> (loaded interval or None, {address: label}), in load order
+        self.by_address = {}
+        self.by_name = {}
+        self.by_lower_name = {}
+
+    def __contains__(self, address):
+        return address in self.by_address
+
+    def __getitem__(self, address):
+        return self.by_address[address]
+
+    def __iter__(self):
+        return iter(self.by_address)
+
+    def __len__(self):
+        return len(self.by_address)
+
+    def get(self, address, default=None):
+        return self.by_address.get(address, default)
+
+    def items(self):
+        return self.by_address.items()
+
+    # Label at address, or None
+    def label(self, address):
+        return self.by_address.get(address)
+
+    # Address of a label, or None; exact case first, like lcc, then ignoring case, like the assembler
+    def address(self, name):
+        if name in self.by_name:
+            return self.by_name[name]
+        return self.by_lower_name.get(name.lower())
+
+    # Add the labels of the .sym file next to obj_name, replacing those it had
+    # interval is the [start, stop) the program was loaded into, labels other programs had there are hidden
+    # Returns the addresses whose label changed
+    def load(self, obj_name, interval=None):
+        before = self.by_address
+        self.files.pop(obj_name, None)
+        self.files[obj_name] = (interval, read_sym(sym_file(obj_name)))
+        self.index()
+        after = self.by_address
+        return set(address for address in set(before) | set(after) if before.get(address) != after.get(address))
+
+    def unload(self, obj_name):
+        interval, labels = self.files.pop(obj_name, (None, {}))
+        self.index()
+        return set(labels)
+
+    def clear(self):
+        changed = set(self.by_address)
+        self.files.clear()
+        self.index()
+        return changed
+
+    # Copy of the loaded files, for Machine.snapshot
+    def save(self):
+        return OrderedDict(self.files)
+
+    def restore(self, files):
+        changed = set(self.by_address)
+        self.files = OrderedDict(files)
+        self.index()
+        changed.update(self.by_address)
+        return changed
+
+    # Rebuild the lookups, programs loaded later win
+    def index(self):
+        by_address = {}
+        for interval, labels in self.files.values():
+            if interval is not None:
+                start, stop = interval
+                for address in [address for address in by_address if start <= address < stop]:
+                    del by_address[address]
+            by_address.update(labels)
+        self.by_address = by_address
+        self.by_name = dict((label, address) for address, label in sorted(by_address.items()))
+        self.by_lower_name = dict((label.lower(), address) for label, address in self.by_name.items())
@@ -0,0 +1,138 @@
+#
+# Execution traces: every executed instruction streamed to a compact binary file
+#
+# A trace is a header followed by a record per instruction, little endian 16 bit words:
+#   PC, IR, value written to the destination register, flags[, store address, word stored]
+# flags holds the destination register (low 3 bits) with REGISTER set if the instruction wrote one,
+# otherwise the value is R0's. Stores set WORD and add the last two words, other records stop after
+# the flags. Files ending in .gz (or written with compress=True) are gzipped, the reader recognizes both.
+#
+# An instruction is recorded once it has executed, straight from its predecoded entry and the
+# registers, as two or three 32 bit words (PC and IR, value and flags, the store) appended to an
+# array that is written out every capacity records or so. Machine.interpret appends its records
+# itself, as record does. Traces are read back a chunk at a time, so neither side keeps more than
+# one buffer of a run in memory.
+#
+
+import gzip
+import sys
+from array import array
+from collections import namedtuple
+
+from instruction_parser import written_register
+
+magic = 'LC3T'
+version = 2
+header = magic + chr(version) + chr(0)
+
+default_capacity = 1 << 16  # Records buffered between writes, up to 768KB
+compress_level = 1  # Traces are big and compress well even at the fastest level
+
+# Flags
+REGISTER = 0b01000
+WORD = 0b10000
+
+# Flags of each opcode, shifted into the upper half of the second 32 bit word of its record
+opcode_flags = [(REGISTER if written_register[opcode] else 0) << 16 for opcode in range(16)]
+store_flags = WORD << 16
+for opcode in (0b0011, 0b0111, 0b1011):  # ST STR STI
+    opcode_flags[opcode] = store_flags
+
+# A decoded record, register/value and address/word are None if the instruction didn't write them
+TraceRecord = namedtuple('TraceRecord', ['pc', 'ir', 'register', 'value', 'address', 'word'])
+
+
+def open_trace(fname, mode, compress):
+    if compress:
+        return gzip.open(fname, mode, compress_level)
+    return open(fname, mode)
+
+
+class TraceWriter(object):
+    # compress defaults to whether fname ends in .gz
+    def __init__(self, fname, compress=None, capacity=default_capacity):
+        if compress is None:
+            compress = fname.endswith('.gz')
+        self.fname = fname
+        self.file = open_trace(fname, 'wb', compress)
+        self.file.write(header)
+        self.capacity = capacity
+        self.words = array('I')  # 32 bit words, two 16 bit words of the file each
+        self.records = 0  # Instructions recorded, Machine.interpret adds the ones it appended
+
+    def __len__(self):
+        return self.records
+
+    # Called after an instruction executes, pc is its address
+    # Stores leave their address in registers.MAR
+    def record(self, pc, entry, registers):
+        words = self.words
+        flags = opcode_flags[entry[0]]
+        register = entry[11]
+        R = registers.registers
+        words.append(pc | entry[-1] << 16)
+        words.append(R[register] | flags | register << 16)
+        if flags == store_flags:
+            words.append(registers.MAR | R[entry[1]] << 16)
+        self.records += 1
+        if len(words) >= 3 * self.capacity:
+            self.flush()
+
+    # Write out the records appended so far
+    def flush(self):
+        words = self.words
+        if sys.byteorder == 'big':
+            words.byteswap()
+        self.file.write(words.tostring())
+        del words[:]
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def format_record(record):
+    text = 'x%04X  x%04X' % (record.pc, record.ir)
+    if record.register is not None:
+        text += '  R%d = x%04X' % (record.register, record.value)
+    if record.address is not None:
+        text += '  mem[x%04X] = x%04X' % (record.address, record.word)
+    return text
+
+
+# Yields a TraceRecord for every instruction in a trace file, reading it a chunk at a time
+def read_trace(fname, chunk_records=default_capacity):
+    with open(fname, 'rb') as f:
+        compressed = f.read(2) == '\x1f\x8b'
+    with open_trace(fname, 'rb', compressed) as f:
+        if f.read(len(header)) != header:
+            raise ValueError("Not an LC3 trace: " + fname)
+        data = ''
+        while True:
+            chunk = f.read(chunk_records * 8)
+            data += chunk
+            words = array('H')
+            words.fromstring(data[:len(data) & ~3])
+            if sys.byteorder == 'big':
+                words.byteswap()
+            i = 0
+            end = len(words) - 3  # A record needs its flags, the fourth word
+            while i < end:
+                flags = words[i + 3]
+                if flags & REGISTER:
+                    register, value = flags & 0b111, words[i + 2]
+                else:
+                    register = value = None
+                if flags & WORD:
+                    if i + 6 > len(words):  # The store is in the next chunk
+                        break
+                    address, word = words[i + 4], words[i + 5]
+                    size = 6
+                else:
+                    address = word = None
+                    size = 4
+                yield TraceRecord(words[i], words[i + 1], register, value, address, word)
+                i += size
+            data = data[2 * i:]
+            if not chunk:
+                return